@@ -0,0 +1,61 @@
+# Streaming ZIP archives used by GET /project/<project_id>/export
+# zipfile writes into a buffer that can't seek, so every entry is followed by a
+# data descriptor (the CRC isn't known before the content has been read) and what
+# has been written can be sent right away, nothing is staged on disk.
+# Entries are stored and not deflated, documents (PDF, DOCX, images) are mostly compressed already.
+
+import io
+import zipfile
+from fastapi.concurrency import run_in_threadpool
+
+
+class ZipBuffer(io.RawIOBase):
+    # write-only file object that zipfile writes the archive into, take() returns
+    # and forgets what was written since the last call
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+async def zip_stream(entries):
+    # entries is an async iterable of (name, size or None, modified datetime, async iterable
+    # of chunks), yields the archive piece by piece, about one piece per chunk
+    buffer = ZipBuffer()
+    archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED)
+    try:
+        async for name, size, modified, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time=modified.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            # zipfile decides on zip64 from the size given upfront
+            info.file_size = size or 0
+            with archive.open(info, "w", force_zip64=size is None) as entry:
+                async for chunk in chunks:
+                    # crc32 of a chunk runs in the threadpool like the sha256 of uploads
+                    await run_in_threadpool(entry.write, chunk)
+                    if buffer.buffer:
+                        yield buffer.take()
+            # the data descriptor
+            yield buffer.take()
+    finally:
+        # when the archive isn't read to the end (the client went away) the entries are closed too
+        if hasattr(entries, "aclose"):
+            await entries.aclose()
+    # the central directory
+    archive.close()
+    yield buffer.take()
@@ -0,0 +1,78 @@
+# Logins/sec per core for every password hashing cost setting
+# Run with: python benchmarks/bench_passwords.py [--seconds 2] [--workers 4] [--json]
+#
+# A login is one verify of a stored hash, so 1 / (time of one verify)
+# is the number of logins a single core can serve. With --workers the same
+# verifies also go through PasswordContext's executor to show how it scales.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from passwords import Argon2Hasher, BcryptHasher, PasswordContext, ScryptHasher
+
+
+def settings():
+    for n in (2 ** 12, 2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16):
+        yield f"scrypt n={n} r=8 p=1", ScryptHasher(n=n, r=8, p=1)
+    try:
+        for memory_cost in (19 * 1024, 64 * 1024, 128 * 1024):
+            yield f"argon2 t=3 m={memory_cost} p=1", Argon2Hasher(time_cost=3, memory_cost=memory_cost, parallelism=1)
+    except ImportError:
+        print("argon2-cffi is not installed, skipping argon2", file=sys.stderr)
+    try:
+        import bcrypt  # noqa: F401
+        for rounds in (10, 11, 12, 13):
+            yield f"bcrypt rounds={rounds}", BcryptHasher(rounds=rounds)
+    except ImportError:
+        print("bcrypt is not installed, skipping bcrypt", file=sys.stderr)
+
+
+def per_core(hasher, stored, seconds):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        hasher.verify("benchmark-password", stored)
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+async def with_executor(hasher, stored, seconds, workers):
+    context = PasswordContext(hasher, workers=workers)
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        await asyncio.gather(*(context.verify("benchmark-password", stored) for _ in range(workers)))
+        count += workers
+    elapsed = time.perf_counter() - started
+    context.executor.shutdown()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2, help="time spent on every setting")
+    parser.add_argument("--workers", type=int, default=0, help="also measure through an executor with this many workers")
+    parser.add_argument("--json", action="store_true", help="print one json object per setting")
+    args = parser.parse_args()
+
+    for name, hasher in settings():
+        stored = hasher.hash("benchmark-password")
+        result = {"setting": name, "logins_per_sec_per_core": round(per_core(hasher, stored, args.seconds), 1)}
+        if args.workers:
+            result[f"logins_per_sec_{args.workers}_workers"] = round(
+                asyncio.run(with_executor(hasher, stored, args.seconds, args.workers)), 1
+            )
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}: {value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
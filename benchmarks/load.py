@@ -0,0 +1,347 @@
+# Load test and latency benchmark of the hot endpoints
+#
+# Boots main:app with uvicorn against the Postgres given by DB_HOST/DB_NAME/DB_USER/DB_PASSWORD
+# and an in-process moto S3 server (or an already running S3 compatible server with --s3-url),
+# seeds users x projects x documents and runs the scenarios below concurrently:
+#   login     - login storm, every user logs in again and again
+#   projects  - GET /projects fan-out over all users
+#   transfer  - upload and download of files of every --sizes entry
+#   invite    - invite burst, the first user invites every other user to a project
+#
+# Results (throughput and p50/p95/p99 per endpoint) are written as json to --output.
+# With --baseline the results are compared to an earlier output, the exit code is 1
+# if any endpoint got slower or lost throughput by more than --tolerance, so CI can gate on it.
+#
+# Run with:
+#   pip install -r benchmarks/requirements.txt
+#   python benchmarks/load.py --users 50 --projects 5 --documents 3 --sizes 1KB,1MB,100MB --output bench.json
+#   python benchmarks/load.py --url http://localhost:8000 --baseline bench.json
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SCENARIOS = ("login", "projects", "transfer", "invite")
+
+UNITS = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, factor in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+    # latencies and errors per endpoint, endpoints are named by route template
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.wall = defaultdict(float)
+
+    async def measure(self, endpoint, request):
+        started = time.perf_counter()
+        try:
+            response = await request()
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            response, failed = None, True
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        if failed:
+            self.errors[endpoint] += 1
+        return response
+
+    def report(self):
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            endpoints[endpoint] = {
+                "count": len(latencies),
+                "errors": self.errors[endpoint],
+                "throughput_rps": round(len(latencies) / self.wall[endpoint], 2) if self.wall[endpoint] else None,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "max_ms": round(max(latencies) * 1000, 2),
+            }
+        return endpoints
+
+
+async def run_concurrently(recorder, endpoints, jobs, concurrency):
+    # runs the coroutine functions in `jobs` with at most `concurrency` in flight,
+    # the wall time counts towards the throughput of every endpoint of the scenario
+    queue = list(jobs)
+    queue.reverse()
+
+    async def worker():
+        while queue:
+            await queue.pop()()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(queue)) or 1)))
+    for endpoint in endpoints:
+        recorder.wall[endpoint] += time.perf_counter() - started
+
+
+class Benchmark:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.recorder = Recorder()
+        self.run_id = uuid.uuid4().hex[:8]
+        self.users = []
+        self.password = "bench-password"
+
+    def auth(self, user):
+        return {"Authorization": f"Bearer {user['token']}"}
+
+    async def seed(self):
+        args = self.args
+        logins = [f"bench-{self.run_id}-u{i}" for i in range(args.users)]
+        await self.parallel([lambda x=x: self.client.post("/auth", json={"username": x, "password": self.password, "repeat_password": self.password}) for x in logins])
+        for login in logins:
+            self.users.append({"login": login, "token": None, "projects": [], "documents": []})
+        await self.parallel([lambda x=x: self.login(x) for x in self.users])
+
+        await self.parallel([
+            lambda user=user, j=j: self.client.post("/projects", json={"name": f"{user['login']}-p{j}", "description": "benchmark"}, headers=self.auth(user))
+            for user in self.users for j in range(args.projects)
+        ])
+        for user in self.users:
+            response = await self.client.get("/projects", params={"fields": "name", "limit": 1000}, headers=self.auth(user))
+            user["projects"] = [x["project_id"] for x in response.json()]
+
+        # random content, identical files would be deduplicated by the content addressed storage
+        await self.parallel([
+            lambda user=user, project_id=project_id, k=k: self.client.post(
+                f"/project/{project_id}/documents", files={"file": (f"doc{k}.bin", os.urandom(1024))}, headers=self.auth(user))
+            for user in self.users for project_id in user["projects"] for k in range(args.documents)
+        ])
+
+    async def parallel(self, jobs):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def run(job):
+            async with semaphore:
+                response = await job()
+                if response is not None and response.status_code >= 400:
+                    raise RuntimeError(f"seeding failed: {response.status_code} {response.text}")
+
+        await asyncio.gather(*(run(job) for job in jobs))
+
+    async def login(self, user):
+        response = await self.client.post("/login", json={"username": user["login"], "password": self.password})
+        if response.status_code == 200:
+            user["token"] = response.json()["token"]
+        return response
+
+    async def scenario_login(self):
+        endpoint = "POST /login"
+        jobs = [
+            lambda user=random.choice(self.users): self.recorder.measure(endpoint, lambda: self.login(user))
+            for _ in range(self.args.requests)
+        ]
+        await run_concurrently(self.recorder, [endpoint], jobs, self.args.concurrency)
+
+    async def scenario_projects(self):
+        endpoint = "GET /projects"
+        jobs = [
+            lambda user=random.choice(self.users): self.recorder.measure(
+                endpoint, lambda: self.client.get("/projects", headers=self.auth(user)))
+            for _ in range(self.args.requests)
+        ]
+        await run_concurrently(self.recorder, [endpoint], jobs, self.args.concurrency)
+
+    async def scenario_transfer(self):
+        user = self.users[0]
+        project_id = user["projects"][0]
+        for text in self.args.sizes.split(","):
+            size = parse_size(text)
+            upload = f"POST /project/{{project_id}}/documents [{text.strip()}]"
+            download = f"GET /document/{{document_id}} [{text.strip()}]"
+            document_ids = []
+
+            async def upload_one():
+                response = await self.recorder.measure(upload, lambda: self.client.post(
+                    f"/project/{project_id}/documents", files={"file": ("bench.bin", os.urandom(size))}, headers=self.auth(user)))
+                if response is not None and response.status_code == 200:
+                    document_ids.append(response.json()["document_id"])
+
+            async def download_one(document_id):
+                async def request():
+                    async with self.client.stream("GET", f"/document/{document_id}", headers=self.auth(user)) as response:
+                        async for _ in response.aiter_bytes():
+                            pass
+                        return response
+                await self.recorder.measure(download, request)
+
+            jobs = [upload_one for _ in range(self.args.transfers)]
+            await run_concurrently(self.recorder, [upload], jobs, self.args.transfer_concurrency)
+            jobs = [lambda x=x: download_one(x) for x in document_ids]
+            await run_concurrently(self.recorder, [download], jobs, self.args.transfer_concurrency)
+
+    async def scenario_invite(self):
+        endpoint = "POST /project/{project_id}/invite"
+        owner = self.users[0]
+        project_id = owner["projects"][0]
+        jobs = [
+            lambda user=user: self.recorder.measure(endpoint, lambda: self.client.post(
+                f"/project/{project_id}/invite", params={"user": user["login"]}, headers=self.auth(owner)))
+            for user in self.users[1:]
+        ]
+        await run_concurrently(self.recorder, [endpoint], jobs, self.args.concurrency)
+
+
+def compare(results, baseline, tolerance):
+    # returns the list of regressions of results against baseline
+    regressions = []
+    for endpoint, base in baseline["endpoints"].items():
+        current = results["endpoints"].get(endpoint)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {base['p95_ms']}ms -> {current['p95_ms']}ms")
+        if base["throughput_rps"] and current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{endpoint}: throughput {base['throughput_rps']}/s -> {current['throughput_rps']}/s")
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{endpoint}: errors {base['errors']} -> {current['errors']}")
+    return regressions
+
+
+def start_s3():
+    from moto.server import ThreadedMotoServer
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def start_app(s3_url, workers):
+    port = free_port()
+    env = dict(os.environ)
+    env.setdefault("aws_access_key_id", "benchmark")
+    env.setdefault("aws_secret_access_key", "benchmark")
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    # the transfer scenario uploads into the same projects again and again
+    env.setdefault("PROJECT_QUOTA_BYTES", "0")
+    # the scenarios hammer the same user on purpose
+    env.setdefault("RATE_LIMIT_LOGIN", "0")
+    env.setdefault("RATE_LIMIT_UPLOAD", "0")
+    env.setdefault("RATE_LIMIT_DOWNLOAD", "0")
+    env.setdefault("RATE_LIMIT_SEARCH", "0")
+    env["S3_ENDPOINT_URL"] = s3_url
+    subprocess.run([sys.executable, "main.py", "migrate"], cwd=ROOT, env=env, check=True)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)],
+        cwd=ROOT, env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("main:app exited during startup")
+        try:
+            if httpx.get(url + "/").status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("main:app didn't start in time")
+
+
+async def run(args, url):
+    results = {
+        "run": {key: value for key, value in vars(args).items() if key not in ("baseline", "output")},
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        benchmark = Benchmark(client, args)
+        started = time.perf_counter()
+        await benchmark.seed()
+        results["seed_seconds"] = round(time.perf_counter() - started, 2)
+        for name in args.scenarios.split(","):
+            await getattr(benchmark, f"scenario_{name.strip()}")()
+    results["endpoints"] = benchmark.recorder.report()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="benchmark an already running app instead of starting one")
+    parser.add_argument("--s3-url", help="S3 compatible server for the started app, moto is started if not given")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the started app")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--projects", type=int, default=5, help="projects per user")
+    parser.add_argument("--documents", type=int, default=3, help="documents per project")
+    parser.add_argument("--requests", type=int, default=500, help="requests of the login and projects scenarios")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--sizes", default="1KB,1MB,10MB", help="file sizes of the transfer scenario, up to e.g. 500MB")
+    parser.add_argument("--transfers", type=int, default=5, help="uploads (and downloads) per size")
+    parser.add_argument("--transfer-concurrency", type=int, default=4)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare the results to this earlier output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    s3_server = app_process = None
+    try:
+        url = args.url
+        if not url:
+            s3_url = args.s3_url
+            if not s3_url:
+                s3_server, s3_url = start_s3()
+            app_process, url = start_app(s3_url, args.workers)
+        results = asyncio.run(run(args, url))
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait()
+        if s3_server:
+            s3_server.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
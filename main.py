@@ -1,25 +1,50 @@
-from typing import Optional, Annotated
-from fastapi import FastAPI, HTTPException, Request, Depends, Header, File
-from fastapi.responses import FileResponse
+import time
+# worker startup time is reported from here, see lifespan below
+IMPORT_STARTED = time.perf_counter()
+
+from typing import Optional, Annotated, Literal
+from fastapi import FastAPI, HTTPException, Request, Depends, Header, File, UploadFile, Query
+from fastapi.responses import StreamingResponse, RedirectResponse, Response, PlainTextResponse, JSONResponse
+from starlette.background import BackgroundTask
+from starlette.routing import Match
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from sqlalchemy import create_engine
+from sqlalchemy import select, insert, delete, update, and_, or_, func, text, literal
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert, TSVECTOR
 from sqlalchemy import Table, MetaData
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, Text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy import Column, Integer, BigInteger, Float, String, ForeignKey, UniqueConstraint, Text, DateTime, JSON, Index, Computed, literal_column, union_all, case
 from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column
 import typing
 from typing import List, Optional
 from sqlalchemy import Integer, String, ForeignKey, Text
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column, sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column, selectinload, load_only
 from sqlalchemy.ext.associationproxy import association_proxy
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from dotenv import load_dotenv
+import asyncio
 import hashlib
+import json
+import math
 import os
+import sys
+import metrics
+import processing
+from passwords import PasswordContext, hasher_from_env
+from storage import UploadAborted, multipart_upload, read_chunks, stream_object, content_disposition, delete_objects, file_digest, list_objects, prefetch_objects
+from archive import zip_stream
 
 # so that aws.env file's contents will override the environment variables given to this container
 load_dotenv()
@@ -29,9 +54,120 @@ SECRET_KEY = "09d25e094faalp9okxvcvd28tjbaf7099f6f0f4caa6cf63b88e8d3e7"
 
 BUCKET_NAME = "FINAL_TASK_S3_BUCKET"
 
+# uploads are sent to S3 in parts of this size, at most S3_UPLOAD_CONCURRENCY
+# parts of a single upload are in flight (and in memory) at the same time
+S3_PART_SIZE = int(os.environ.get("S3_PART_SIZE", str(8 * 1024 * 1024)))
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", "4"))
+# number of files of a batch upload that are sent to S3 at the same time
+S3_BATCH_CONCURRENCY = int(os.environ.get("S3_BATCH_CONCURRENCY", "4"))
+# content that is being sent to S3 is registered as a pending upload, its object isn't deleted
+# while the upload runs. Pending uploads of a worker that died stop counting after this long.
+UPLOAD_PENDING_TIMEOUT = timedelta(seconds=float(os.environ.get("UPLOAD_PENDING_TIMEOUT", str(6 * 3600))))
+
+# bytes the documents of a single project may take up, 0 disables the limit
+PROJECT_QUOTA_BYTES = int(os.environ.get("PROJECT_QUOTA_BYTES", str(5 * 1024 ** 3)))
+
+# in-memory cache of serialized project/document listings (per process), 0 disables it
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", "0"))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+
+# most memberships a single POST /project/<project_id>/members may change
+MEMBERS_MAX_BATCH = int(os.environ.get("MEMBERS_MAX_BATCH", "1000"))
+
+# page size limits of GET /projects
+PROJECTS_PAGE_SIZE = int(os.environ.get("PROJECTS_PAGE_SIZE", "100"))
+PROJECTS_MAX_PAGE_SIZE = int(os.environ.get("PROJECTS_MAX_PAGE_SIZE", "1000"))
+
+# "stream" proxies downloads through the api, "redirect" answers with a
+# presigned S3 url so that the file never goes through this process
+DOWNLOAD_MODE = os.environ.get("DOWNLOAD_MODE", "stream")
+PRESIGNED_URL_EXPIRES = int(os.environ.get("PRESIGNED_URL_EXPIRES", "300"))
+
+# GET /project/<project_id>/export reads EXPORT_PREFETCH objects from S3 ahead of the one being sent,
+# each holding at most EXPORT_BUFFERED_CHUNKS chunks of 1 MiB
+EXPORT_PREFETCH = int(os.environ.get("EXPORT_PREFETCH", "4"))
+EXPORT_BUFFERED_CHUNKS = int(os.environ.get("EXPORT_BUFFERED_CHUNKS", "4"))
+EXPORT_MANIFEST_NAME = "manifest.json"
+
+# uploaded documents are processed (thumbnails, page count, text) by the outbox worker
+# in a pool of PROCESSING_WORKERS processes, larger files than PROCESSING_MAX_BYTES are skipped.
+# Processing jobs are leased for PROCESSING_LEASE seconds, after that another worker may take them over.
+PROCESSING_WORKERS = int(os.environ.get("PROCESSING_WORKERS", "2"))
+PROCESSING_MAX_BYTES = int(os.environ.get("PROCESSING_MAX_BYTES", str(50 * 1024 * 1024)))
+PROCESSING_LEASE = timedelta(seconds=float(os.environ.get("PROCESSING_LEASE", "900")))
+
+# GET /search: page size limits and how much of a document's extracted text is indexed
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get("SEARCH_MAX_PAGE_SIZE", "100"))
+SEARCH_TEXT_MAX_CHARS = int(os.environ.get("SEARCH_TEXT_MAX_CHARS", "100000"))
+
+# change feed (GET /events): NOTIFY channel, seconds between heartbeats, events buffered per
+# connection before it has to catch up from the database, most events replayed at once, how long events are kept
+EVENTS_CHANNEL = "project_events"
+# NOTIFY channel of the changes to memberships, see announce_access_change
+ACCESS_CHANNEL = "access_changes"
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", "15"))
+EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_REPLAY_LIMIT = int(os.environ.get("EVENTS_REPLAY_LIMIT", "1000"))
+EVENTS_RETENTION = timedelta(hours=float(os.environ.get("EVENTS_RETENTION_HOURS", "24")))
+
+def parse_rate(value):
+    # "<requests>/<seconds>": bursts of up to <requests> and <requests> per <seconds> on average,
+    # "0" turns the limit off
+    if not value or value == "0":
+        return None
+    requests, seconds = value.split("/")
+    return int(requests), float(seconds)
+
+# token bucket per user (per client address for login and registration) and route class,
+# the buckets are kept in postgres so that all workers share them
+RATE_LIMITS = {
+    "login": parse_rate(os.environ.get("RATE_LIMIT_LOGIN", "20/60")),
+    "upload": parse_rate(os.environ.get("RATE_LIMIT_UPLOAD", "120/60")),
+    "download": parse_rate(os.environ.get("RATE_LIMIT_DOWNLOAD", "600/60")),
+    "search": parse_rate(os.environ.get("RATE_LIMIT_SEARCH", "120/60")),
+}
+ROUTE_CLASSES = {
+    ("POST", "/auth"): "login",
+    ("POST", "/login"): "login",
+    ("POST", "/project/{project_id}/documents"): "upload",
+    ("PUT", "/document/{document_id}"): "upload",
+    ("GET", "/document/{document_id}"): "download",
+    ("GET", "/project/{project_id}/export"): "download",
+    ("POST", "/project/{project_id}/export"): "download",
+    ("GET", "/search"): "search",
+}
+# bytes of uploads and of downloads one worker moves at the same time, transfers that don't fit
+# are answered with 503 and Retry-After right away, 0 turns the budget off
+UPLOAD_BYTES_IN_FLIGHT = int(os.environ.get("UPLOAD_BYTES_IN_FLIGHT", str(1024 ** 3)))
+DOWNLOAD_BYTES_IN_FLIGHT = int(os.environ.get("DOWNLOAD_BYTES_IN_FLIGHT", str(2 * 1024 ** 3)))
+OVERLOAD_RETRY_AFTER = int(os.environ.get("OVERLOAD_RETRY_AFTER", "1"))
+
 # encryption algorithm
 ALGORITHM = "HS256"
 
+# tokens of users with more projects than this don't carry an access claim
+TOKEN_ACL_LIMIT = int(os.environ.get("TOKEN_ACL_LIMIT", "100"))
+
+# Server-Timing response headers with db/s3/total time of the request
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+# statements slower than this (in milliseconds) are printed
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+
+# background jobs (outbox): how often the table is polled, how many jobs are
+# claimed at once, retry backoff and how long finished jobs are kept
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_DELAY = float(os.environ.get("OUTBOX_RETRY_DELAY", "2"))
+OUTBOX_MAX_RETRY_DELAY = float(os.environ.get("OUTBOX_MAX_RETRY_DELAY", "300"))
+OUTBOX_RETENTION = timedelta(hours=float(os.environ.get("OUTBOX_RETENTION_HOURS", "24")))
+
+# postgres readiness probe on startup: number of attempts and their backoff (seconds)
+DB_CONNECT_ATTEMPTS = int(os.environ.get("DB_CONNECT_ATTEMPTS", "10"))
+DB_CONNECT_RETRY_DELAY = float(os.environ.get("DB_CONNECT_RETRY_DELAY", "0.5"))
+DB_CONNECT_MAX_RETRY_DELAY = float(os.environ.get("DB_CONNECT_MAX_RETRY_DELAY", "5"))
+
 # -----------------
 # 1. Pydantic Models (Data Structure/Validation)
 # -----------------
@@ -47,7 +183,8 @@ class UserToProject(Base):
     __tablename__ = 'user2project'
     
     user_id: Mapped[int] = mapped_column(ForeignKey('user_table.user_id'), primary_key=True)
-    project_id: Mapped[int] = mapped_column(ForeignKey('project.project_id'), primary_key=True)
+    # the primary key only helps lookups by user_id, members of a project are found through this index
+    project_id: Mapped[int] = mapped_column(ForeignKey('project.project_id'), primary_key=True, index=True)
     
     access_type: Mapped[str] = mapped_column(String(12), nullable=False)
     
@@ -61,7 +198,10 @@ class ProjectToDocument(Base):
     __tablename__ = 'project2document'
     
     project_id: Mapped[int] = mapped_column(ForeignKey('project.project_id'), primary_key=True)
-    document_id: Mapped[int] = mapped_column(ForeignKey('document.document_id'), primary_key=True)
+    # the project of a document is found through this index
+    document_id: Mapped[int] = mapped_column(ForeignKey('document.document_id'), primary_key=True, index=True)
+    # copy of the blob's size, so project totals can be computed without joining document and blob
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
     
     # Relationships to core models
     project: Mapped["Project"] = relationship(back_populates="documents_link")
@@ -78,6 +218,9 @@ class UserTable(Base):
     user_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     login: Mapped[str] = mapped_column(String(50), unique=True, nullable=False)
     password_hash: Mapped[str] = mapped_column(Text, nullable=False)
+    # bumped whenever the user's project access changes,
+    # access claims of tokens issued with an older generation are ignored
+    token_generation: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
     
     # 1. One-to-Many Relationship to the Association Object
     projects_link: Mapped[List[UserToProject]] = relationship(back_populates="user")
@@ -95,6 +238,18 @@ class Project(Base):
     name: Mapped[str] = mapped_column(String(100), unique=True, nullable=False)
     # Use Optional for Python typing of nullable column
     description: Mapped[Optional[str]] = mapped_column(String(500)) 
+    # maintained in the same transaction as the project's documents, see adjust_project_totals
+    document_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    total_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0, server_default="0")
+    # bumped by every change of the project's info, documents or members, the ETags of the read routes are built from it
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # full-text search over name and description, a generated column so postgres keeps it
+    # up to date on every insert and update, deferred so that it isn't loaded with the project
+    search_vector: Mapped[Optional[str]] = mapped_column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B')",
+        persisted=True,
+    ), deferred=True)
     
     # User Relationships
     users_link: Mapped[List[UserToProject]] = relationship(back_populates="project")
@@ -109,50 +264,457 @@ class Project(Base):
     )
 
 
+class Blob(Base):
+    # A stored S3 object. Objects are content addressed, the key is the sha256 of the content,
+    # and shared by all documents with the same content. Only the object is shared,
+    # every upload is a document of its own with its own name.
+    __tablename__ = 'blob'
+
+    s3_key: Mapped[str] = mapped_column(Text, primary_key=True)
+    # filled from the finished S3 upload
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
+    etag: Mapped[Optional[str]] = mapped_column(String(100))
+    # number of documents stored in the object, the blob
+    # and its S3 object are deleted when it drops to zero
+    ref_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # filled by the processing job after the upload: pending, done, failed or skipped
+    processing_state: Mapped[Optional[str]] = mapped_column(String(12))
+    # pdf, docx or image, None for anything else
+    content_kind: Mapped[Optional[str]] = mapped_column(String(12))
+    page_count: Mapped[Optional[int]] = mapped_column(Integer)
+    # derived objects stored next to the blob's own object
+    thumbnail_key: Mapped[Optional[str]] = mapped_column(Text)
+    text_key: Mapped[Optional[str]] = mapped_column(Text)
+    # extracted text cut at SEARCH_TEXT_MAX_CHARS, only kept for the search index
+    content_text: Mapped[Optional[str]] = mapped_column(Text, deferred=True)
+    search_vector: Mapped[Optional[str]] = mapped_column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', coalesce(content_text, '')), 'C')",
+        persisted=True,
+    ), deferred=True)
+
+
 class Document(Base):
     __tablename__ = 'document'
 
     document_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    s3_key: Mapped[str] = mapped_column(Text, unique=True, nullable=False)
+    # the stored content, see Blob
+    s3_key: Mapped[str] = mapped_column(ForeignKey('blob.s3_key'), nullable=False, index=True)
     name: Mapped[str] = mapped_column(String(150), nullable=False)
+    # file names are split at . _ and - so that "minutes" finds "minutes_2024.docx",
+    # the text of the content is searched through blob.search_vector
+    search_vector: Mapped[Optional[str]] = mapped_column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', translate(coalesce(name, ''), '._-', '   ')), 'A')",
+        persisted=True,
+    ), deferred=True)
+
+    # size, ETag and processing results of the content, loaded with the document
+    blob: Mapped[Blob] = relationship(lazy="joined")
     
     # Project Relationships
     projects_link: Mapped[List[ProjectToDocument]] = relationship(back_populates="document")
     projects: Mapped[List[Project]] = association_proxy(
         "projects_link", "project", creator=lambda proj: ProjectToDocument(project=proj)
     )
+
+class UserProjectSummary(Base):
+    # totals over all projects a user is a member of, maintained incrementally
+    # together with user2project and project2document, see add_to_summaries
+    __tablename__ = 'user_project_summary'
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('user_table.user_id'), primary_key=True)
+    project_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    document_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+Index("ix_project_search", Project.search_vector, postgresql_using="gin")
+Index("ix_document_search", Document.search_vector, postgresql_using="gin")
+Index("ix_blob_search", Blob.search_vector, postgresql_using="gin")
+
+class ProjectEvent(Base):
+    # changes pushed to GET /events, kept for EVENTS_RETENTION so that clients can resume
+    __tablename__ = 'project_event'
+
+    event_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # no foreign key, the events of a deleted project are kept
+    project_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # set for events that only concern one user (project_deleted is sent to every member separately)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer, index=True)
+    kind: Mapped[str] = mapped_column(String(30), nullable=False)
+    data: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class OutboxJob(Base):
+    # side effects (S3 deletions, document processing) that have to happen after a transaction commits,
+    # they are written in the same transaction and run by OutboxWorker
+    __tablename__ = 'outbox'
+
+    job_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(30), nullable=False)
+    # {"keys": [...]} for delete_objects and process_documents, only the keys that are still left
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer)
+    status: Mapped[str] = mapped_column(String(12), nullable=False, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_error: Mapped[Optional[str]] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    available_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+# the worker only ever looks for pending jobs that are due
+Index("ix_outbox_pending", OutboxJob.available_at, postgresql_where=OutboxJob.status == "pending")
+
+class PendingUpload(Base):
+    # content an upload is sending to S3, committed before the transfer starts and deleted
+    # together with the upload's documents, see store_documents and referenced_keys
+    __tablename__ = 'pending_upload'
+
+    upload_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    s3_key: Mapped[str] = mapped_column(Text, nullable=False, index=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+class RateLimit(Base):
+    # token buckets of the rate limited route classes, see take_token
+    __tablename__ = 'rate_limit'
+
+    # "<route class>:user:<user_id>" or "<route class>:address:<client address>"
+    key: Mapped[str] = mapped_column(String(200), primary_key=True)
+    tokens: Mapped[float] = mapped_column(Float, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
 # -----------------
 # 2. Application Setup
 # -----------------
 
+# Nothing here connects to postgres or S3 while the module is imported,
+# the engine is created by the lifespan and the S3 client on first use.
+# Tables and the bucket are created by `python main.py migrate`.
+engine = None
+Session = None
+s3 = None
+
+def init_database():
+    global engine, Session
+    if engine is not None:
+        return
+    connection_url = URL.create(
+        drivername="postgresql+asyncpg",
+        username=os.environ["DB_USER"],
+        host=os.environ["DB_HOST"],
+        database=os.environ["DB_NAME"],
+        password=os.environ["DB_PASSWORD"]
+    )
+    # connection pool settings, every request borrows one connection from this pool
+    # through its own session (see get_session below)
+    engine = create_async_engine(
+        connection_url,
+        pool_size=int(os.environ.get("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+        pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        pool_pre_ping=True,
+    )
+    # count and time every SQL statement, see metrics.py
+    metrics.instrument_engine(engine.sync_engine, SLOW_QUERY_MS / 1000)
+    # expire_on_commit=False so that objects returned from the routes
+    # can still be serialized after the commit without another round trip
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+
+def get_s3():
+    global s3
+    if s3 is None:
+        # S3_ENDPOINT_URL points the client to an S3 compatible server (minio, moto) instead of AWS
+        s3 = boto3.client('s3',
+                 endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+                 aws_access_key_id=os.environ["aws_access_key_id"],
+                 aws_secret_access_key=os.environ["aws_secret_access_key"])
+        metrics.instrument_s3(s3)
+    return s3
+
+async def wait_for_database():
+    # postgres may still be starting (docker-compose), retry with exponential backoff
+    # instead of sleeping for a fixed time, gives up after DB_CONNECT_ATTEMPTS
+    delay = DB_CONNECT_RETRY_DELAY
+    for attempt in range(1, DB_CONNECT_ATTEMPTS + 1):
+        try:
+            async with engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+            return
+        except (OSError, SQLAlchemyError) as e:
+            if attempt == DB_CONNECT_ATTEMPTS:
+                raise
+            print(f"database is not ready ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_CONNECT_MAX_RETRY_DELAY)
+
+# columns computed from other rows, when one of them is added to an existing table
+# migrate fills them once, the same as rebuild-summaries
+COUNTER_COLUMNS = {"project.document_count", "project.total_bytes", "project2document.size"}
+
+# document columns that moved to blob
+BLOB_COLUMNS = ["size", "etag", "processing_state", "content_kind", "page_count", "thumbnail_key", "text_key", "content_text"]
+
+def split_shared_documents(connection):
+    # Documents used to be unique by s3 key, hold the size, ETag and processing results of their
+    # content and be linked to every project the same content was uploaded to. Their content
+    # moves to blob and a document linked to several projects is copied, so that every project
+    # has its own. Returns whether there was anything to move, the counters have to be rebuilt then.
+    if connection.execute(text(
+        "SELECT 1 FROM information_schema.table_constraints "
+        "WHERE table_schema = current_schema() AND table_name = 'document' AND constraint_name = 'document_s3_key_key'"
+    )).first() is None:
+        return False
+    existing = set(connection.scalars(text(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'document'"
+    )))
+    columns = ", ".join(["s3_key", *(x for x in BLOB_COLUMNS if x in existing)])
+    connection.execute(text(f"INSERT INTO blob ({columns}) SELECT {columns} FROM document ON CONFLICT DO NOTHING"))
+    # search_vector is added again by add_missing_columns, without the text
+    dropped = ", ".join(f"DROP COLUMN IF EXISTS {x}" for x in ["search_vector", "ref_count", *BLOB_COLUMNS])
+    connection.execute(text(f"ALTER TABLE document DROP CONSTRAINT document_s3_key_key, {dropped}"))
+    # every link of a document but the first gets a copy of it
+    links = connection.execute(text(
+        "SELECT project_id, document_id FROM ("
+        "SELECT project_id, document_id, row_number() OVER (PARTITION BY document_id ORDER BY project_id) AS n "
+        "FROM project2document) AS links WHERE n > 1"
+    )).all()
+    for project_id, document_id in links:
+        copy_id = connection.scalar(text(
+            "INSERT INTO document (s3_key, name) SELECT s3_key, name FROM document "
+            "WHERE document_id = :document_id RETURNING document_id"
+        ), {"document_id": document_id})
+        connection.execute(text(
+            "UPDATE project2document SET document_id = :copy_id WHERE project_id = :project_id AND document_id = :document_id"
+        ), {"copy_id": copy_id, "project_id": project_id, "document_id": document_id})
+    connection.execute(text("ALTER TABLE document ADD FOREIGN KEY (s3_key) REFERENCES blob (s3_key)"))
+    print(f"moved the documents' content to blob, copied {len(links)} shared documents")
+    return True
+
+def add_missing_columns(connection):
+    # create_all only creates the tables that don't exist yet, the columns and indexes
+    # added to the models since a table was created are added here.
+    # migrate runs on every start, so nothing is altered (ALTER TABLE locks the whole table,
+    # even with IF NOT EXISTS) unless it is missing. Returns the added columns as "table.column".
+    existing = {
+        f"{x.table_name}.{x.column_name}" for x in connection.execute(text(
+            "SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = current_schema()"
+        ))
+    }
+    preparer = connection.dialect.identifier_preparer
+    added = set()
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if f"{table.name}.{column.name}" in existing:
+                continue
+            connection.execute(text(
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ADD COLUMN {CreateColumn(column).compile(dialect=connection.dialect)}"
+            ))
+            added.add(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    return added
+
+async def migrate():
+    init_database()
+    await wait_for_database()
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        split = await connection.run_sync(split_shared_documents)
+        added = await connection.run_sync(add_missing_columns)
+    if added:
+        print(f"added {', '.join(sorted(added))}")
+    if split or added & COUNTER_COLUMNS:
+        # the counters of rows that existed before the counter columns did
+        # (the sizes of documents uploaded before size existed come from the bucket: python main.py reconcile-storage)
+        print("rebuilding the counters")
+        async with Session.begin() as session:
+            await recompute_counters(session)
+    await engine.dispose()
+    client = get_s3()
+    if BUCKET_NAME not in [x["Name"] for x in client.list_buckets()["Buckets"]]:
+        client.create_bucket(Bucket=BUCKET_NAME)
+
+@asynccontextmanager
+async def lifespan(app):
+    started = time.perf_counter()
+    init_database()
+    await wait_for_database()
+    outbox_worker.start()
+    event_hub.start()
+    ready = time.perf_counter()
+    metrics.startup_seconds.set(started - IMPORT_STARTED, "import")
+    metrics.startup_seconds.set(ready - started, "lifespan")
+    print(f"worker {os.getpid()} ready in {ready - IMPORT_STARTED:.3f}s "
+          f"(import {started - IMPORT_STARTED:.3f}s, database {ready - started:.3f}s)")
+    yield
+    await outbox_worker.stop()
+    await event_hub.stop()
+    if processing_executor is not None:
+        processing_executor.shutdown(wait=False, cancel_futures=True)
+    await engine.dispose()
+
+# -----------------
+# Admission control (rate limits + transfer budgets)
+# -----------------
+
+async def take_token(key, limit):
+    # takes a token from the bucket with one statement on its own short transaction,
+    # returns None if it got one and otherwise the seconds until it will
+    capacity, period = limit
+    rate = capacity / period
+    now = datetime.utcnow()
+    refilled = func.least(capacity, RateLimit.tokens + func.extract("epoch", now - RateLimit.updated_at) * rate)
+    statement = pg_insert(RateLimit).values(key=key, tokens=capacity - 1, updated_at=now)
+    # an empty bucket is left as it is, a client that keeps trying doesn't push its next token further away
+    statement = statement.on_conflict_do_update(
+        index_elements=[RateLimit.key],
+        set_={"tokens": refilled - 1, "updated_at": now},
+        where=refilled >= 1,
+    ).returning(RateLimit.tokens)
+    async with engine.begin() as connection:
+        tokens = (await connection.execute(statement)).scalar()
+    if tokens is not None:
+        return None
+    # at most the time an empty bucket takes to get one token
+    return 1 / rate
+
+class TransferBudget:
+    # bytes of the transfers (uploads or downloads) this worker has in flight.
+    # A transfer reserves its size for as long as it runs, one that doesn't fit is turned away
+    # instead of waiting behind the others. A single transfer takes at most a quarter of the
+    # budget so that a large one doesn't shut out all the others.
+    def __init__(self, direction, limit):
+        self.direction = direction
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size):
+        # returns a Reservation, None if the bytes don't fit right now
+        if not self.limit:
+            return Reservation(self, 0)
+        size = min(size or 0, self.limit // 4)
+        if self.used + size > self.limit:
+            return None
+        self.used += size
+        metrics.transfer_bytes_in_flight.set(self.used, self.direction)
+        return Reservation(self, size)
+
+class Reservation:
+    def __init__(self, budget, size):
+        self.budget = budget
+        self.size = size
+
+    def release(self):
+        # safe to call more than once
+        if self.size:
+            self.budget.used -= self.size
+            self.size = 0
+            metrics.transfer_bytes_in_flight.set(self.budget.used, self.budget.direction)
+
+upload_budget = TransferBudget("upload", UPLOAD_BYTES_IN_FLIGHT)
+download_budget = TransferBudget("download", DOWNLOAD_BYTES_IN_FLIGHT)
+
+def overloaded(budget):
+    metrics.transfer_rejections.inc(budget.direction)
+    return HTTPException(
+        status_code=503,
+        detail="The server is busy, try again later!",
+        headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)},
+    )
+
+def reserve_download(size):
+    reservation = download_budget.reserve(size)
+    if reservation is None:
+        raise overloaded(download_budget)
+    return reservation
+
+def stream_reserved(chunks, reservation):
+    # the reservation is released when the stream ends, and by the response's background
+    # task in case the client went away before the stream started
+    async def stream():
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            reservation.release()
+    return stream(), BackgroundTask(reservation.release)
+
+def route_class(request):
+    # the route is matched here already so that requests are turned away before their body is read
+    for route in request.app.router.routes:
+        match, child_scope = route.matches(request.scope)
+        if match == Match.FULL:
+            return ROUTE_CLASSES.get((request.method, route.path)), route
+    return None, None
+
+def rate_limit_key(request, route_class):
+    # requests are counted against the token's user, login, registration and
+    # requests with an invalid token against the client's address
+    if route_class != "login":
+        try:
+            payload = jwt.decode(extract_token(request.headers.get("authorization", "")), SECRET_KEY, algorithms=[ALGORITHM])
+            if "user_id" in payload:
+                return f"{route_class}:user:{payload['user_id']}"
+        except JWTError:
+            pass
+    return f"{route_class}:address:{request.client.host if request.client else ''}"
+
 # Create the FastAPI application instance
 app = FastAPI(
     title="Final Task",
     description="Project management api",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-connection_url = URL.create(
-    drivername="postgresql",
-    username=os.environ["DB_USER"],
-    host=os.environ["DB_HOST"],
-    database=os.environ["DB_NAME"],
-    password=os.environ["DB_PASSWORD"]
-)
-
-engine = create_engine(connection_url)
-
-s3 = boto3.client('s3',
-         aws_access_key_id=os.environ["aws_access_key_id"],
-         aws_secret_access_key=os.environ["aws_secret_access_key"])
-
-if BUCKET_NAME not in [x["Name"] for x in s3.list_buckets()["Buckets"]]:
-    s3.create_bucket(Bucket=BUCKET_NAME)
-
-# wait until postgres container can accept connection requests
-__import__("time").sleep(5)
+# added before record_request_metrics so that it runs inside it and the rejected requests are recorded
+@app.middleware("http")
+async def admit_request(request: Request, call_next):
+    name, route = route_class(request)
+    if name is None:
+        return await call_next(request)
+    # label the rejected requests with their route template
+    request.scope["route"] = route
+    if RATE_LIMITS.get(name):
+        try:
+            wait = await take_token(rate_limit_key(request, name), RATE_LIMITS[name])
+        except (OSError, SQLAlchemyError) as e:
+            # the limiter lets requests through while postgres can't be reached
+            print(e)
+            wait = None
+        metrics.rate_limit_requests.inc(name, "admitted" if wait is None else "limited")
+        if wait is not None:
+            return JSONResponse({"detail": "Too many requests, try again later!"}, status_code=429, headers={"Retry-After": str(math.ceil(wait))})
+    reservation = None
+    if name == "upload":
+        # reserved before the body is read, without Content-Length one part upload's worth
+        size = request.headers.get("content-length")
+        reservation = upload_budget.reserve(int(size) if size and size.isdigit() else S3_PART_SIZE * S3_UPLOAD_CONCURRENCY)
+        if reservation is None:
+            exception = overloaded(upload_budget)
+            return JSONResponse({"detail": exception.detail}, status_code=exception.status_code, headers=exception.headers)
+    try:
+        return await call_next(request)
+    finally:
+        if reservation is not None:
+            reservation.release()
 
-Base.metadata.create_all(engine)
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    stats = metrics.RequestStats()
+    token = metrics.current_request.set(stats)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        metrics.current_request.reset(token)
+        # label by route template so that every project/document doesn't get its own series
+        route = request.scope.get("route")
+        metrics.observe_request(stats, request.method, route.path if route else "unmatched", status)
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(stats)
+    return response
 
 class LoginModel(BaseModel):
     username: str
@@ -167,12 +729,30 @@ class ProjectModel(BaseModel):
     name: str
     description: str
 
+class MemberModel(BaseModel):
+    login: str
+    access_type: Literal["owner", "participant"] = "participant"
+
+class MembersModel(BaseModel):
+    members: List[MemberModel]
+
+class ExportedDocumentModel(BaseModel):
+    document_id: int
+    etag: Optional[str] = None
+
+class ExportManifestModel(BaseModel):
+    documents: List[ExportedDocumentModel] = []
+
 # -----------------
 # 3. Routes (Endpoints)
 # -----------------
 
-Session = sessionmaker(bind=engine)
-session = Session()
+async def get_session():
+    # every request gets its own session, it is closed (and its connection
+    # returned to the pool) when the request is finished
+    init_database()
+    async with Session() as session:
+        yield session
 
 def extract_token(header_value):
     token = header_value.strip()
@@ -187,7 +767,10 @@ def verify_token(authorization: Annotated[str | None, Header()] = None):
             # raise error if the token is not correct
             token = extract_token(authorization)
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            return True
+            if "user_id" not in payload:
+                # issued before user_id was added to the claims
+                raise JWTError("Token doesn't carry user_id")
+            return payload
         else:
             raise JWTError()
     except JWTError as e:
@@ -197,10 +780,817 @@ def verify_token(authorization: Annotated[str | None, Header()] = None):
             detail="Could not validate jwt token",
         )
 
-def hash_data(strdata):
-    m = hashlib.sha256()
-    m.update(strdata.encode("utf-8"))
-    return m.hexdigest()
+# -----------------
+# Authorization (access levels + ACL cache)
+# -----------------
+
+# an access type satisfies every level that is lower or equal to it
+ACCESS_LEVELS = {"participant": 1, "owner": 2}
+
+@dataclass
+class Access:
+    user_id: int
+    project_id: int
+    access_type: str
+    document_id: Optional[int] = None
+
+class ACLCache:
+    # bounded LRU cache with a time to live, holds resolved access rights
+    # so that repeated requests of the same user don't hit the database
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        access, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return access
+
+    def set(self, key, access):
+        self.entries[key] = (access, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def invalidate(self, project_id=None, document_id=None):
+        for key, (access, _) in list(self.entries.items()):
+            if (project_id is not None and access.project_id == project_id) or \
+               (document_id is not None and access.document_id == document_id):
+                del self.entries[key]
+
+acl_cache = ACLCache(
+    maxsize=int(os.environ.get("ACL_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("ACL_CACHE_TTL", "30")),
+)
+
+# user_id -> token_generation, so that checking the access claim of a token
+# doesn't need a query on every request.
+# Both caches are per worker. The worker that changes access drops its entries right after the commit,
+# the other workers when the change's NOTIFY reaches them (see announce_access_change), usually
+# milliseconds later. While a worker's LISTEN connection is down its entries live up to ACL_CACHE_TTL,
+# so until then a removed member or demoted owner keeps the old rights on that worker.
+generation_cache = ACLCache(
+    maxsize=int(os.environ.get("ACL_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("ACL_CACHE_TTL", "30")),
+)
+
+def encode_acl_claim(memberships):
+    # compact, versioned access claim: {"v": 1, "o": [owned ids], "p": [participated ids]}
+    claim = {"v": 1, "o": [], "p": []}
+    for project_id, access_type in memberships:
+        claim["o" if access_type == "owner" else "p"].append(project_id)
+    return claim
+
+def decode_acl_claim(claim, project_id):
+    if not claim or claim.get("v") != 1:
+        return None
+    if project_id in claim["o"]:
+        return "owner"
+    if project_id in claim["p"]:
+        return "participant"
+    return None
+
+async def current_generation(session, user_id):
+    generation = generation_cache.get(user_id)
+    if generation is None:
+        generation = await session.scalar(select(UserTable.token_generation).where(UserTable.user_id == user_id))
+        if generation is None:
+            raise HTTPException(
+                status_code=403,
+                detail="User couldn't find!",
+            )
+        generation_cache.set(user_id, generation)
+    return generation
+
+async def bump_generation(session, user_ids):
+    # invalidates the access claims of every token issued to these users
+    await session.execute(
+        update(UserTable)
+        .where(UserTable.user_id.in_(user_ids))
+        .values(token_generation=UserTable.token_generation + 1)
+    )
+
+async def announce_access_change(session, user_ids=(), project_id=None, document_id=None):
+    # sent with NOTIFY in the caller's transaction, so every worker hears about it once it commits
+    # and drops what it has cached about these users, project and document with forget_access.
+    # Returns the change, the caller passes it to forget_access after its commit.
+    change = {"user_ids": list(user_ids), "project_id": project_id, "document_id": document_id}
+    payload = json.dumps(change)
+    if len(payload) > 7900:
+        # NOTIFY payloads are limited to 8000 bytes, the workers drop everything instead
+        payload = json.dumps({"all": True})
+    await session.execute(select(func.pg_notify(ACCESS_CHANNEL, payload)))
+    return change
+
+def forget_access(change):
+    if change.get("all"):
+        acl_cache.entries.clear()
+        generation_cache.entries.clear()
+        return
+    if change.get("project_id") is not None:
+        acl_cache.invalidate(project_id=change["project_id"])
+    if change.get("document_id") is not None:
+        acl_cache.invalidate(document_id=change["document_id"])
+    for user_id in change.get("user_ids", ()):
+        generation_cache.discard(user_id)
+
+def project_not_found():
+    return HTTPException(
+        status_code=404,
+        detail="Project doesn't exist!",
+    )
+
+def check_access_level(access_type, level, detail):
+    if access_type is None or ACCESS_LEVELS[access_type] < ACCESS_LEVELS[level]:
+        raise HTTPException(
+            status_code=403,
+            detail=detail,
+        )
+
+async def resolve_project_access(session, login, project_id):
+    # login -> user_id -> access_type in one query,
+    # access_type is None if the user has no relation to the project
+    row = (await session.execute(
+        select(UserTable.user_id, UserToProject.access_type)
+        .select_from(UserTable)
+        .outerjoin(UserToProject, and_(UserToProject.user_id == UserTable.user_id, UserToProject.project_id == project_id))
+        .where(UserTable.login == login)
+    )).first()
+    if not row:
+        raise HTTPException(
+            status_code=403,
+            detail="User couldn't find!",
+        )
+    return Access(user_id=row.user_id, project_id=project_id, access_type=row.access_type)
+
+async def resolve_document_access(session, login, document_id):
+    # login -> user_id -> project of the document -> access_type in one query,
+    # project_id is None if the document doesn't exist
+    rows = (await session.execute(
+        select(UserTable.user_id, ProjectToDocument.project_id, UserToProject.access_type)
+        .select_from(UserTable)
+        .outerjoin(ProjectToDocument, ProjectToDocument.document_id == document_id)
+        .outerjoin(UserToProject, and_(UserToProject.user_id == UserTable.user_id, UserToProject.project_id == ProjectToDocument.project_id))
+        .where(UserTable.login == login)
+    )).all()
+    if not rows:
+        raise HTTPException(
+            status_code=403,
+            detail="User couldn't find!",
+        )
+    if rows[0].project_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Document doesn't exist!",
+        )
+    # pick the highest access the user has through any project of the document
+    row = max(rows, key=lambda x: ACCESS_LEVELS.get(x.access_type, 0))
+    return Access(user_id=row.user_id, project_id=row.project_id, access_type=row.access_type, document_id=document_id)
+
+def require_project_access(level):
+    detail = "You don't have owner access to this project!" if level == "owner" else "You don't have access to this project!"
+
+    async def dependency(project_id: int, payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+        # the token's own access claim is trusted as long as its generation is current,
+        # a project missing from the claim falls back to the database
+        access_type = decode_acl_claim(payload.get("acl"), project_id)
+        if access_type and payload.get("gen") == await current_generation(session, payload["user_id"]):
+            check_access_level(access_type, level, detail)
+            return Access(user_id=payload["user_id"], project_id=project_id, access_type=access_type)
+        key = ("project", payload["login"], project_id)
+        access = acl_cache.get(key)
+        if access is None:
+            access = await resolve_project_access(session, payload["login"], project_id)
+            if access.access_type is not None:
+                acl_cache.set(key, access)
+        check_access_level(access.access_type, level, detail)
+        return access
+    return dependency
+
+def require_document_access(level):
+    async def dependency(document_id: int, payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+        key = ("document", payload["login"], document_id)
+        access = acl_cache.get(key)
+        if access is None:
+            access = await resolve_document_access(session, payload["login"], document_id)
+            if access.access_type is not None:
+                acl_cache.set(key, access)
+        check_access_level(access.access_type, level, "You don't have access to this project!")
+        return access
+    return dependency
+
+# hashing and verifying passwords runs in this executor, see passwords.py
+passwords = PasswordContext(
+    hasher_from_env(),
+    workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "0")) or None,
+    executor=os.environ.get("PASSWORD_HASH_EXECUTOR", "thread"),
+)
+
+# -----------------
+# Background jobs (outbox)
+# -----------------
+
+def enqueue_object_deletion(session, user_id, s3_keys):
+    # the objects are deleted by the worker once the caller's transaction commits
+    if not s3_keys:
+        return None
+    job = OutboxJob(kind="delete_objects", payload={"keys": list(s3_keys)}, user_id=user_id)
+    session.add(job)
+    return job
+
+def enqueue_processing(session, s3_keys):
+    # newly stored documents are processed by the worker once the upload is committed
+    if not s3_keys:
+        return None
+    job = OutboxJob(kind="process_documents", payload={"keys": list(s3_keys)})
+    session.add(job)
+    return job
+
+async def lock_keys(session, s3_keys):
+    # Transaction level advisory locks on content keys, only held by short transactions.
+    # An upload holds them while it registers its pending uploads and while it commits its
+    # documents, whoever deletes blobs or objects takes them too, so that an object is never
+    # seen without its blob or its pending upload. Sorted, two uploads with overlapping keys can't deadlock.
+    if s3_keys:
+        await session.execute(
+            text("SELECT pg_advisory_xact_lock(hashtextextended(key, 0)) FROM unnest(CAST(:keys AS text[])) AS key"),
+            {"keys": sorted(set(s3_keys))},
+        )
+
+async def try_lock_keys(session, s3_keys):
+    # same locks as lock_keys without waiting, returns the keys that were locked
+    if not s3_keys:
+        return set()
+    return set((await session.scalars(
+        text("SELECT key FROM unnest(CAST(:keys AS text[])) AS key WHERE pg_try_advisory_xact_lock(hashtextextended(key, 0))"),
+        {"keys": sorted(set(s3_keys))},
+    )).all())
+
+async def referenced_keys(session, s3_keys):
+    # the keys whose objects have to stay: a blob refers to them or an upload is still sending them
+    live = datetime.utcnow() - UPLOAD_PENDING_TIMEOUT
+    return set((await session.scalars(union_all(
+        select(Blob.s3_key).where(Blob.s3_key.in_(s3_keys)),
+        select(PendingUpload.s3_key).where(PendingUpload.s3_key.in_(s3_keys), PendingUpload.created_at > live),
+    ))).all())
+
+def derived_keys(s3_key):
+    # objects derived from a document are stored as <s3_key>.<suffix>
+    return f"{s3_key}.thumbnail.png", f"{s3_key}.txt"
+
+# started on first use, see process_document
+processing_executor = None
+# a document's content is held in memory from its download until the pool is done with it,
+# at most PROCESSING_WORKERS of them at once, whatever the size of the batch
+processing_slots = asyncio.Semaphore(PROCESSING_WORKERS)
+
+async def process_document(s3_key, size):
+    # Returns the values of the blob's processing columns. S3 errors are raised so that the job
+    # is retried, files that can't be processed are marked as failed.
+    global processing_executor
+    if size is not None and size > PROCESSING_MAX_BYTES:
+        return {"processing_state": "skipped"}
+    async with processing_slots:
+        s3_object = await run_in_threadpool(get_s3().get_object, Bucket=BUCKET_NAME, Key=s3_key)
+        data = await run_in_threadpool(s3_object["Body"].read)
+        if processing_executor is None:
+            processing_executor = ProcessPoolExecutor(max_workers=PROCESSING_WORKERS)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(processing_executor, processing.process, data)
+        except BrokenProcessPool:
+            # a worker process died (e.g. out of memory), start a new pool and retry the job later
+            processing_executor = None
+            raise
+        except Exception as e:
+            print(e)
+            return {"processing_state": "failed"}
+        finally:
+            del data
+    values = {"content_kind": result["kind"], "page_count": result["page_count"], "processing_state": "done"}
+    thumbnail_key, text_key = derived_keys(s3_key)
+    if result["thumbnail"] is not None:
+        await run_in_threadpool(
+            get_s3().put_object, Bucket=BUCKET_NAME, Key=thumbnail_key, Body=result["thumbnail"], ContentType="image/png",
+        )
+        values["thumbnail_key"] = thumbnail_key
+    if result["text"] is not None:
+        await run_in_threadpool(
+            get_s3().put_object, Bucket=BUCKET_NAME, Key=text_key, Body=result["text"].encode("utf-8"),
+            ContentType="text/plain; charset=utf-8",
+        )
+        values["text_key"] = text_key
+        values["content_text"] = result["text"][:SEARCH_TEXT_MAX_CHARS]
+    return values
+
+class OutboxWorker:
+    # Runs the pending jobs of the outbox table. Jobs are claimed with
+    # FOR UPDATE SKIP LOCKED, so every uvicorn worker can run its own OutboxWorker.
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stats = {"jobs_done": 0, "jobs_failed": 0, "retries": 0, "deleted_objects": 0, "s3_calls": 0, "processed_documents": 0}
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def wake(self):
+        # called after a commit that queued jobs, so that they don't wait for the next poll
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                claimed = await self.run_once()
+            except Exception as e:
+                print(e)
+                claimed = 0
+            # a full batch means there may be more jobs waiting
+            if claimed < OUTBOX_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+
+    async def run_once(self):
+        processes = []
+        async with Session.begin() as session:
+            now = datetime.utcnow()
+            jobs = (await session.scalars(
+                select(OutboxJob)
+                .where(OutboxJob.status == "pending", OutboxJob.available_at <= now)
+                .order_by(OutboxJob.job_id)
+                .limit(OUTBOX_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            )).all()
+            if jobs:
+                errors = {}
+                deletions = [x for x in jobs if x.kind == "delete_objects"]
+                if deletions:
+                    errors["delete_objects"] = await self.delete(session, deletions)
+                # processing takes long, it runs after this transaction so that it holds
+                # neither the claimed rows nor a connection. Until it is finished the jobs are leased,
+                # if this worker dies another one takes them over once the lease runs out.
+                processes = [x for x in jobs if x.kind == "process_documents"]
+                for job in processes:
+                    job.available_at = now + PROCESSING_LEASE
+                for job in jobs:
+                    if job.kind != "process_documents":
+                        self.finish(job, errors.get(job.kind, {}), now)
+            # finished jobs are only kept for the status endpoint
+            await session.execute(
+                delete(OutboxJob).where(OutboxJob.status == "done", OutboxJob.finished_at < now - OUTBOX_RETENTION)
+            )
+            await session.execute(delete(ProjectEvent).where(ProjectEvent.created_at < now - EVENTS_RETENTION))
+            # a bucket that has been idle for its whole period is full again, the same as no row
+            periods = [x[1] for x in RATE_LIMITS.values() if x]
+            await session.execute(delete(RateLimit).where(RateLimit.updated_at < now - timedelta(seconds=max(periods, default=0))))
+            await session.execute(delete(PendingUpload).where(PendingUpload.created_at < now - UPLOAD_PENDING_TIMEOUT))
+        if processes:
+            errors = await self.process(processes)
+            async with Session.begin() as session:
+                now = datetime.utcnow()
+                for job in processes:
+                    job = await session.get(OutboxJob, job.job_id, with_for_update=True)
+                    if job is not None and job.status == "pending":
+                        self.finish(job, errors, now)
+        return len(jobs)
+
+    async def delete(self, session, jobs):
+        keys = {key for job in jobs for key in job.payload["keys"]}
+        # content addressed objects (and the objects derived from them) may have been
+        # uploaded again since the job was queued. An upload that is committing its documents
+        # holds the lock of its key, those keys are tried again later.
+        bases = {key.split(".", 1)[0] for key in keys}
+        locked = await try_lock_keys(session, bases)
+        referenced = await referenced_keys(session, locked)
+        to_delete = sorted(key for key in keys if key.split(".", 1)[0] in locked and key.split(".", 1)[0] not in referenced)
+        errors = await delete_objects(get_s3(), BUCKET_NAME, to_delete)
+        self.stats["s3_calls"] += (len(to_delete) + 999) // 1000
+        self.stats["deleted_objects"] += len(to_delete) - len(errors)
+        errors.update((key, "an upload of the same content is being committed") for key in keys if key.split(".", 1)[0] not in locked)
+        return errors
+
+    async def process(self, jobs):
+        # runs outside of the claim transaction, every blob is saved on its own
+        keys = {key for job in jobs for key in job.payload["keys"]}
+        # blobs deleted since the upload aren't processed anymore
+        async with Session() as session:
+            blobs = (await session.execute(select(Blob.s3_key, Blob.size).where(Blob.s3_key.in_(keys)))).all()
+        last_attempt = {key for job in jobs if job.attempts + 1 >= OUTBOX_MAX_ATTEMPTS for key in job.payload["keys"]}
+        results = await asyncio.gather(*(self.process_one(x, x.s3_key in last_attempt) for x in blobs), return_exceptions=True)
+        errors = {}
+        for blob, result in zip(blobs, results):
+            if isinstance(result, BaseException):
+                errors[blob.s3_key] = str(result) or type(result).__name__
+            else:
+                self.stats["processed_documents"] += 1
+        return errors
+
+    async def process_one(self, blob, last_attempt):
+        try:
+            values = await process_document(blob.s3_key, blob.size)
+        except Exception:
+            if last_attempt:
+                await self.save(blob, {"processing_state": "failed"})
+            raise
+        await self.save(blob, values)
+
+    async def save(self, blob, values):
+        async with Session.begin() as session:
+            updated = await session.scalar(
+                update(Blob).where(Blob.s3_key == blob.s3_key).values(**values).returning(Blob.s3_key)
+            )
+            if updated is not None:
+                # the processing state is part of the listings of the projects with this content
+                await bump_document_projects(session, select(Document.document_id).where(Document.s3_key == blob.s3_key))
+                return
+            # deleted while it was processed, the deletion job didn't know about the derived objects.
+            # They are kept if the same content has been uploaded again in the meantime.
+            written = [values[x] for x in ("thumbnail_key", "text_key") if values.get(x)]
+            if written:
+                await lock_keys(session, [blob.s3_key])
+                if await session.scalar(select(Blob.s3_key).where(Blob.s3_key == blob.s3_key)) is None:
+                    await delete_objects(get_s3(), BUCKET_NAME, written)
+
+    def finish(self, job, errors, now):
+        remaining = [key for key in job.payload["keys"] if key in errors]
+        job.attempts += 1
+        if not remaining:
+            job.status = "done"
+            job.finished_at = now
+            self.stats["jobs_done"] += 1
+            return
+        # only the failed keys are retried, with exponential backoff
+        job.payload = {"keys": remaining}
+        job.last_error = errors[remaining[0]]
+        if job.attempts >= OUTBOX_MAX_ATTEMPTS:
+            job.status = "failed"
+            job.finished_at = now
+            self.stats["jobs_failed"] += 1
+        else:
+            delay = min(OUTBOX_RETRY_DELAY * 2 ** (job.attempts - 1), OUTBOX_MAX_RETRY_DELAY)
+            job.available_at = now + timedelta(seconds=delay)
+            self.stats["retries"] += 1
+
+outbox_worker = OutboxWorker()
+
+# -----------------
+# Conditional requests (ETags + response cache)
+# -----------------
+
+class ResponseCache:
+    # LRU cache of serialized JSON responses, bounded by the total size of the bodies.
+    # Keys contain the ETag, so an entry is never served after the data has changed,
+    # outdated entries simply fall out at the end.
+    def __init__(self, maxbytes, max_entry_bytes):
+        self.maxbytes = maxbytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    def set(self, key, body):
+        if not self.maxbytes or len(body) > min(self.maxbytes, self.max_entry_bytes):
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.maxbytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES)
+
+def project_etag(project_id, version):
+    return f'"{project_id}-{version}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [x.strip() for x in if_none_match.split(",")]
+    # weak comparison, as If-None-Match requires
+    return "*" in tags or etag in [x[2:] if x.startswith("W/") else x for x in tags]
+
+async def conditional_json(request, user_id, etag, build, headers=None):
+    # answers If-None-Match with 304, otherwise serves the body from the response
+    # cache or builds it with `build` (an async function returning the data)
+    headers = {**(headers or {}), "ETag": etag}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        metrics.response_cache_requests.inc("not_modified")
+        return Response(status_code=304, headers=headers)
+    key = (user_id, request.url.path, request.url.query, etag)
+    body = response_cache.get(key)
+    if body is None:
+        metrics.response_cache_requests.inc("miss")
+        # same encoding as FastAPI's JSONResponse
+        body = json.dumps(jsonable_encoder(await build()), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        response_cache.set(key, body)
+    else:
+        metrics.response_cache_requests.inc("hit")
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# -----------------
+# Change feed (LISTEN/NOTIFY + server-sent events)
+# -----------------
+
+async def emit_events(session, events):
+    # events are dicts of project_id, kind, data and optionally user_id. They are stored for
+    # replay and sent with NOTIFY, postgres delivers notifications only if the transaction commits.
+    if not events:
+        return
+    rows = (await session.execute(
+        insert(ProjectEvent).values(events)
+        .returning(ProjectEvent.event_id, ProjectEvent.project_id, ProjectEvent.user_id, ProjectEvent.kind, ProjectEvent.data)
+    )).all()
+    payloads = []
+    for row in rows:
+        payload = json.dumps(event_message(row))
+        if len(payload.encode("utf-8")) > 7900:
+            # NOTIFY payloads are limited to 8000 bytes, subscribers read this one from the table
+            payload = json.dumps({"id": row.event_id, "truncated": True})
+        payloads.append(payload)
+    await session.execute(
+        text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+        {"channel": EVENTS_CHANNEL, "payloads": payloads},
+    )
+
+def event_message(event):
+    return {"id": event.event_id, "project_id": event.project_id, "user_id": event.user_id, "kind": event.kind, "data": event.data}
+
+# put into a subscriber's queue when it has to catch up from the database
+RESYNC = {"kind": "resync"}
+
+class Subscriber:
+    # one GET /events stream, the queue is bounded so that a slow client never holds up the others
+    def __init__(self, user_id, project_ids):
+        self.user_id = user_id
+        self.project_ids = set(project_ids)
+        self.queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+
+    def wants(self, event):
+        if event["user_id"] is not None:
+            return event["user_id"] == self.user_id
+        # data["user_id"] is the member an event is about, e.g. the invited user
+        return event["project_id"] in self.project_ids or event["data"].get("user_id") == self.user_id
+
+    def deliver(self, event):
+        if event is not RESYNC:
+            if not self.wants(event):
+                return
+            # follow the user's memberships right away, the stream may be behind
+            if event["kind"] == "member_invited" and event["data"]["user_id"] == self.user_id:
+                self.project_ids.add(event["project_id"])
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the client doesn't keep up: drop what is buffered, it is read from the table again
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            metrics.events_resyncs.inc()
+
+class EventHub:
+    # One LISTEN connection per uvicorn worker, notifications are fanned out to the
+    # streams of this worker. The connection is reopened with backoff when it is lost,
+    # every stream catches up from the table afterwards.
+    def __init__(self):
+        self.subscribers = set()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def subscribe(self, user_id, project_ids):
+        subscriber = Subscriber(user_id, project_ids)
+        self.subscribers.add(subscriber)
+        metrics.events_subscribers.set(len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        metrics.events_subscribers.set(len(self.subscribers))
+
+    def broadcast(self, event):
+        for subscriber in list(self.subscribers):
+            subscriber.deliver(event)
+
+    def on_notify(self, connection, pid, channel, payload):
+        event = json.loads(payload)
+        metrics.events_received.inc()
+        self.broadcast(RESYNC if event.get("truncated") else event)
+
+    def on_access_change(self, connection, pid, channel, payload):
+        forget_access(json.loads(payload))
+
+    async def run(self):
+        delay = DB_CONNECT_RETRY_DELAY
+        while True:
+            try:
+                async with engine.connect() as connection:
+                    raw = (await connection.get_raw_connection()).driver_connection
+                    lost = asyncio.Event()
+                    raw.add_termination_listener(lambda _: lost.set())
+                    try:
+                        await raw.add_listener(EVENTS_CHANNEL, self.on_notify)
+                        # the same connection keeps the access caches of this worker current
+                        await raw.add_listener(ACCESS_CHANNEL, self.on_access_change)
+                        delay = DB_CONNECT_RETRY_DELAY
+                        # events and access changes may have been sent while nobody was listening
+                        forget_access({"all": True})
+                        self.broadcast(RESYNC)
+                        await lost.wait()
+                    finally:
+                        # never hand a listening connection back to the pool
+                        await connection.invalidate()
+            except Exception as e:
+                print(e)
+            self.broadcast(RESYNC)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_CONNECT_MAX_RETRY_DELAY)
+
+event_hub = EventHub()
+
+async def replay_events(subscriber, last_id):
+    # the user's projects are read again, they may have changed while events were missed
+    async with Session() as session:
+        subscriber.project_ids = set((await session.scalars(
+            select(UserToProject.project_id).where(UserToProject.user_id == subscriber.user_id)
+        )).all())
+        events = (await session.scalars(
+            select(ProjectEvent)
+            .where(ProjectEvent.event_id > last_id, or_(
+                and_(ProjectEvent.user_id.is_(None), ProjectEvent.project_id.in_(subscriber.project_ids)),
+                ProjectEvent.user_id == subscriber.user_id,
+            ))
+            .order_by(ProjectEvent.event_id)
+            .limit(EVENTS_REPLAY_LIMIT + 1)
+        )).all()
+        oldest, newest = (await session.execute(select(func.min(ProjectEvent.event_id), func.max(ProjectEvent.event_id)))).one()
+    # too far behind (or behind the retention), the client has to load everything again
+    # and continues with the newest event, returns None then
+    if len(events) > EVENTS_REPLAY_LIMIT or (oldest is not None and last_id < oldest - 1):
+        return None, newest
+    return [event_message(x) for x in events], last_id
+
+def sse_message(event):
+    data = {"project_id": event["project_id"], **event["data"]}
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(data)}\n\n"
+
+# -----------------
+# Counters (project totals + per-user summaries)
+# -----------------
+
+SUMMARY_COLUMNS = ("project_count", "document_count", "total_bytes")
+
+class QuotaExceeded(Exception):
+    pass
+
+async def add_to_summaries(session, rows):
+    # rows is a select of (user_id, project_count, document_count, total_bytes) deltas,
+    # users without a summary row get one
+    statement = pg_insert(UserProjectSummary).from_select(["user_id", *SUMMARY_COLUMNS], rows)
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[UserProjectSummary.user_id],
+        set_={x: getattr(UserProjectSummary, x) + getattr(statement.excluded, x) for x in SUMMARY_COLUMNS},
+    ))
+
+def member_deltas(project_id, projects=0, documents=0, size=0):
+    # the same deltas for every member of the project
+    return select(
+        UserToProject.user_id, literal(projects, Integer), literal(documents, Integer), literal(size, BigInteger)
+    ).where(UserToProject.project_id == project_id)
+
+async def bump_document_projects(session, document_ids):
+    # the projects listing these documents get a new version, so their ETags change
+    await session.execute(
+        update(Project)
+        .where(Project.project_id.in_(
+            select(ProjectToDocument.project_id).where(ProjectToDocument.document_id.in_(document_ids))
+        ))
+        .values(version=Project.version + 1)
+    )
+
+async def adjust_project_totals(session, project_id, documents, size):
+    # returns the project's new total_bytes, the update locks the project's row
+    # so concurrent uploads to the same project see each other's bytes
+    if not documents:
+        return None
+    total_bytes = await session.scalar(
+        update(Project)
+        .where(Project.project_id == project_id)
+        .values(
+            document_count=Project.document_count + documents,
+            total_bytes=Project.total_bytes + size,
+            version=Project.version + 1,
+        )
+        .returning(Project.total_bytes)
+    )
+    await add_to_summaries(session, member_deltas(project_id, documents=documents, size=size))
+    return total_bytes
+
+async def recompute_counters(session):
+    # recomputes all counters from the documents and the link tables
+    await session.execute(
+        update(Blob).values(ref_count=(
+            select(func.count())
+            .where(Document.s3_key == Blob.s3_key)
+            .scalar_subquery()
+        ))
+    )
+    await session.execute(
+        update(ProjectToDocument)
+        .where(ProjectToDocument.document_id == Document.document_id, Document.s3_key == Blob.s3_key)
+        .values(size=Blob.size)
+    )
+    totals = (
+        select(
+            ProjectToDocument.project_id,
+            func.count().label("documents"),
+            func.coalesce(func.sum(ProjectToDocument.size), 0).label("size"),
+        )
+        .group_by(ProjectToDocument.project_id)
+        .subquery()
+    )
+    await session.execute(update(Project).values(document_count=0, total_bytes=0))
+    await session.execute(
+        update(Project)
+        .where(Project.project_id == totals.c.project_id)
+        .values(document_count=totals.c.documents, total_bytes=totals.c.size)
+    )
+    await session.execute(delete(UserProjectSummary))
+    await session.execute(insert(UserProjectSummary).from_select(
+        ["user_id", *SUMMARY_COLUMNS],
+        select(UserToProject.user_id, func.count(), func.sum(Project.document_count), func.sum(Project.total_bytes))
+        .join(Project, Project.project_id == UserToProject.project_id)
+        .group_by(UserToProject.user_id),
+    ))
+
+async def rebuild_summaries():
+    # for rows that existed before the counters did: python main.py rebuild-summaries
+    init_database()
+    async with Session.begin() as session:
+        await recompute_counters(session)
+    await engine.dispose()
+
+async def reconcile_storage():
+    # Rebuilds blob sizes and the counters from what is actually stored in S3:
+    # python main.py reconcile-storage
+    # The bucket is listed in pages of 1000 keys, every page is matched to the
+    # blobs with one query and their sizes are fixed with one bulk update.
+    init_database()
+    report = {"objects": 0, "unreferenced_objects": 0, "resized_blobs": 0, "missing_objects": 0}
+    matched = 0
+    async for page in list_objects(get_s3(), BUCKET_NAME):
+        # objects derived from blobs (<s3_key>.<suffix>) aren't blobs themselves
+        sizes = {x["Key"]: x["Size"] for x in page if "." not in x["Key"]}
+        # a short transaction per page, uploads aren't blocked while the bucket is listed
+        async with Session.begin() as session:
+            blobs = (await session.execute(select(Blob.s3_key, Blob.size).where(Blob.s3_key.in_(sizes)))).all()
+            changed = [{"s3_key": x.s3_key, "size": sizes[x.s3_key]} for x in blobs if x.size != sizes[x.s3_key]]
+            if changed:
+                await session.execute(update(Blob), changed)
+                # sizes are part of the project listings
+                await bump_document_projects(
+                    session, select(Document.document_id).where(Document.s3_key.in_([x["s3_key"] for x in changed]))
+                )
+        report["objects"] += len(sizes)
+        report["unreferenced_objects"] += len(sizes) - len(blobs)
+        report["resized_blobs"] += len(changed)
+        matched += len(blobs)
+    async with Session.begin() as session:
+        report["missing_objects"] = await session.scalar(select(func.count()).select_from(Blob)) - matched
+        await recompute_counters(session)
+    await engine.dispose()
+    print(report)
+    return report
 
 # GET Endpoint: Root Path
 @app.get("/")
@@ -210,23 +1600,37 @@ async def read_root():
 
 # POST /auth - Create user (login, password, repeat password)
 @app.post("/auth")
-async def auth_method(model: RegisterModel):
+async def auth_method(model: RegisterModel, session: AsyncSession = Depends(get_session)):
     if (model.password != model.repeat_password):
         raise HTTPException(
             status_code=400,
             detail="Passwords are different!",
         )
-    new_data = UserTable(login=model.username, password_hash=hash_data(model.password))
+    new_data = UserTable(login=model.username, password_hash=await passwords.hash(model.password))
     session.add(new_data)
-    session.commit()
+    await session.commit()
 
 # POST /login - Login into service (login, password)
 @app.post("/login")
-async def login_method(model: LoginModel):
-    user_query = session.query(UserTable)
-    user = user_query.filter(UserTable.login == model.username).first()
-    if user and hash_data(model.password) == user.password_hash:
-        to_encode = {"login": model.username}
+async def login_method(model: LoginModel, session: AsyncSession = Depends(get_session)):
+    user = await session.scalar(select(UserTable).where(UserTable.login == model.username))
+    if user:
+        valid, new_hash = await passwords.verify(model.password, user.password_hash)
+    else:
+        valid, new_hash = await passwords.verify_unknown(model.password)
+    if valid:
+        if new_hash:
+            # legacy sha256 hash or outdated cost settings
+            user.password_hash = new_hash
+            await session.commit()
+        to_encode = {"login": model.username, "user_id": user.user_id, "gen": user.token_generation}
+        memberships = (await session.execute(
+            select(UserToProject.project_id, UserToProject.access_type)
+            .where(UserToProject.user_id == user.user_id)
+            .limit(TOKEN_ACL_LIMIT + 1)
+        )).all()
+        if len(memberships) <= TOKEN_ACL_LIMIT:
+            to_encode["acl"] = encode_acl_claim(memberships)
         expire = datetime.utcnow() + timedelta(minutes=60)
         to_encode.update({"exp": expire})
         encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
@@ -240,324 +1644,821 @@ async def login_method(model: LoginModel):
 # POST /projects - Create project from details (name, description).
 # Automatically gives access to created project to user, making him the owner (admin of the project).
 @app.post("/projects")
-async def post_project(model: ProjectModel, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        # create a project
-        new_project = Project(name=model.name, description=model.description)
-        session.add(new_project)
-        session.commit()
-        # get user id from username, get username from jwt
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        user_id = user.user_id
-        # add user2project, userid, projectid as owner access
-        new_relation = UserToProject(user_id=user_id, project_id=new_project.project_id, access_type="owner")
-        session.add(new_relation)
-        session.commit()
+async def post_project(model: ProjectModel, payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+    # create a project
+    new_project = Project(name=model.name, description=model.description)
+    session.add(new_project)
+    await session.flush()
+    # add user2project, userid, projectid as owner access
+    new_relation = UserToProject(user_id=payload["user_id"], project_id=new_project.project_id, access_type="owner")
+    session.add(new_relation)
+    await add_to_summaries(session, member_deltas(new_project.project_id, projects=1))
+    await session.commit()
+
+PROJECT_FIELDS = ("name", "description", "documents")
+
+def document_info(document):
+    return {
+        "document_id": document.document_id,
+        "name": document.name,
+        "s3_key": document.s3_key,
+        "size": document.blob.size,
+        "etag": document.blob.etag,
+        "processing_state": document.blob.processing_state,
+        "content_kind": document.blob.content_kind,
+        "page_count": document.blob.page_count,
+        "thumbnail_key": document.blob.thumbnail_key,
+        "text_key": document.blob.text_key,
+    }
+
+def project_info(project, fields=PROJECT_FIELDS):
+    info = {"project_id": project.project_id}
+    if "name" in fields:
+        info["name"] = project.name
+    if "description" in fields:
+        info["description"] = project.description
+    if "documents" in fields:
+        links = sorted(project.documents_link, key=lambda x: x.document_id)
+        info["documents"] = [document_info(x.document) for x in links]
+    return info
 
 # GET /projects - Get all projects, accessible for a user. Returns list of projects full info(details + documents).
+# Keyset pagination: pass the last project_id of a page as after_id to get the next one,
+# X-Next-After-Id is set while there may be more pages.
+# fields=name,description,documents selects what is returned for every project.
 @app.get("/projects")
-async def get_projects(authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        # get user id
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        if not user:
+async def get_projects(request: Request, after_id: int = 0, limit: int = Query(PROJECTS_PAGE_SIZE, ge=1, le=PROJECTS_MAX_PAGE_SIZE), fields: Optional[str] = None, payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+    fields = PROJECT_FIELDS if fields is None else tuple(x.strip() for x in fields.split(",") if x.strip())
+    if any(x not in PROJECT_FIELDS for x in fields):
+        raise HTTPException(
+            status_code=400,
+            detail=f"fields can only contain {', '.join(PROJECT_FIELDS)}!",
+        )
+    # the page's project ids and versions make up the ETag, a page that didn't change
+    # is answered without loading the projects and their documents
+    versions = (await session.execute(
+        select(Project.project_id, Project.version)
+        .join(UserToProject, UserToProject.project_id == Project.project_id)
+        .where(UserToProject.user_id == payload["user_id"], Project.project_id > after_id)
+        .order_by(Project.project_id)
+        .limit(limit)
+    )).all()
+    headers = {}
+    if len(versions) == limit:
+        headers["X-Next-After-Id"] = str(versions[-1].project_id)
+    etag = '"' + hashlib.sha256(repr((fields, [tuple(x) for x in versions])).encode()).hexdigest()[:32] + '"'
+
+    async def build():
+        if not versions:
             return []
-        user_id = user.user_id
-        # get all projects with that user_id
-        project_ids = session.query(UserToProject).filter(UserToProject.user_id == user_id).all()
-        project_ids = [x.project_id for x in project_ids]
-        projects = session.query(Project).filter(Project.project_id.in_(project_ids)).all()
-        return projects
+        columns = [getattr(Project, x) for x in fields if x != "documents"]
+        query = (
+            select(Project)
+            .where(Project.project_id.in_([x.project_id for x in versions]))
+            .order_by(Project.project_id)
+            .options(load_only(Project.project_id, *columns))
+        )
+        if "documents" in fields:
+            # one more query for the documents of the whole page, no lazy load per project
+            query = query.options(selectinload(Project.documents_link).joinedload(ProjectToDocument.document))
+        projects = (await session.scalars(query)).all()
+        return [project_info(x, fields) for x in projects]
+
+    return await conditional_json(request, payload["user_id"], etag, build, headers)
+
+# GET /search?q= - Ranked full-text search over the names and descriptions of the user's projects
+# and the names and text of their documents. q uses the web search syntax ("quoted phrase", or, -word).
+# Paginated with offset, X-Next-Offset is set while there may be more results.
+@app.get("/search")
+async def search(response: Response, q: str, offset: int = Query(0, ge=0), limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE), payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+    if not q.strip():
+        raise HTTPException(
+            status_code=400,
+            detail="q can't be empty!",
+        )
+    query = func.websearch_to_tsquery("english", q)
+    # only the user's projects are searched, the membership join runs in the same query
+    projects = (
+        select(
+            literal_column("'project'").label("kind"),
+            Project.project_id,
+            literal(None, Integer).label("document_id"),
+            Project.name,
+            func.ts_rank(Project.search_vector, query).label("rank"),
+        )
+        .join(UserToProject, and_(UserToProject.project_id == Project.project_id, UserToProject.user_id == payload["user_id"]))
+        .where(Project.search_vector.op("@@")(query))
+    )
+    # the name is the document's own, the text belongs to its content
+    documents = (
+        select(
+            literal_column("'document'").label("kind"),
+            ProjectToDocument.project_id,
+            Document.document_id,
+            Document.name,
+            func.ts_rank(Document.search_vector.op("||")(Blob.search_vector), query).label("rank"),
+        )
+        .join(Blob, Blob.s3_key == Document.s3_key)
+        .join(ProjectToDocument, ProjectToDocument.document_id == Document.document_id)
+        .join(UserToProject, and_(UserToProject.project_id == ProjectToDocument.project_id, UserToProject.user_id == payload["user_id"]))
+        .where(or_(Document.search_vector.op("@@")(query), Blob.search_vector.op("@@")(query)))
+    )
+    results = union_all(projects, documents).subquery()
+    page = (
+        select(results)
+        .order_by(results.c.rank.desc(), results.c.kind, results.c.project_id, results.c.document_id)
+        .offset(offset)
+        .limit(limit)
+        .subquery()
+    )
+    # snippets are only made for the rows of the page
+    rows = (await session.execute(
+        select(page, func.ts_headline("english", func.coalesce(Blob.content_text, Project.description, ""), query).label("snippet"))
+        .outerjoin(Document, Document.document_id == page.c.document_id)
+        .outerjoin(Blob, Blob.s3_key == Document.s3_key)
+        .outerjoin(Project, and_(page.c.document_id.is_(None), Project.project_id == page.c.project_id))
+        .order_by(page.c.rank.desc(), page.c.kind, page.c.project_id, page.c.document_id)
+    )).all()
+    if len(rows) == limit:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return [
+        {
+            "kind": x.kind,
+            "project_id": x.project_id,
+            "document_id": x.document_id,
+            "name": x.name,
+            "rank": x.rank,
+            "snippet": x.snippet,
+        }
+        for x in rows
+    ]
+
+# GET /projects/summary - Number of projects and documents and their total size over all projects of the user
+@app.get("/projects/summary")
+async def get_projects_summary(payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+    summary = await session.get(UserProjectSummary, payload["user_id"])
+    return {x: getattr(summary, x) if summary else 0 for x in SUMMARY_COLUMNS}
 
 # GET /project/<project_id>/info - Return project’s details, if user has access
 @app.get("/projects/{project_id}/info")
-async def get_project(project_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        # get user id
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        if not user:
-            raise HTTPException(
-                status_code=403,
-                detail="User couldn't find!",
-            )
-        user_id = user.user_id
-        # check access
-        relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-        if not relation:
-            raise HTTPException(
-                status_code=403,
-                detail="You don't have access to this project!",
-            )
-        # 
-        return session.query(Project).filter(Project.project_id == project_id).first()
+async def get_project(project_id: int, request: Request, access: Access = Depends(require_project_access("participant")), session: AsyncSession = Depends(get_session)):
+    version = await session.scalar(select(Project.version).where(Project.project_id == project_id))
+    if version is None:
+        raise project_not_found()
+    return await conditional_json(request, access.user_id, project_etag(project_id, version), lambda: session.get(Project, project_id))
 
 # PUT /project/<project_id>/info - Update projects details - name, description. Returns the updated project’s info
 @app.put("/projects/{project_id}/info")
-async def put_project(model: ProjectModel, project_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None): # needs to get a project model from request body
-    if authorized:
-        # get user id
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        if not user:
-            raise HTTPException(
-                status_code=403,
-                detail="User couldn't find!",
-            )
-        user_id = user.user_id
-        # check access
-        relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-        if not relation:
-            raise HTTPException(
-                status_code=403,
-                detail="You don't have access to this project!",
-            )
-        # get project and update
-        project = session.query(Project).filter(Project.project_id == project_id).first()
-        project.name = model.name
-        project.description = model.description
-        session.commit()
+async def put_project(model: ProjectModel, project_id: int, access: Access = Depends(require_project_access("participant")), session: AsyncSession = Depends(get_session)): # needs to get a project model from request body
+    # get project and update
+    project = await session.get(Project, project_id)
+    if project is None:
+        raise project_not_found()
+    project.name = model.name
+    project.description = model.description
+    project.version = Project.version + 1
+    await emit_events(session, [{
+        "project_id": project_id, "kind": "project_updated",
+        "data": {"name": model.name, "description": model.description},
+    }])
+    await session.commit()
 
 # DELETE /project/<project_id>- Delete project, can only be performed by the projects’ owner. Deletes the corresponding documents
 @app.delete("/project/{project_id}")
-async def delete_project(project_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        # get user id
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        if not user:
-            raise HTTPException(
-                status_code=403,
-                detail="User couldn't find!",
-            )
-        user_id = user.user_id
-        # check access
-        relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-        if not relation or relation.access_type != "owner":
-            raise HTTPException(
-                status_code=403,
-                detail="You don't have owner access to this project!",
-            )
-            return
-        # get and delete the project
-        project = session.query(Project).filter(Project.project_id == project_id).first()
-        session.delete(project)
-        # get document ids related to this project
-        document_relations = session.query(ProjectToDocument).filter(ProjectToDocument.project_id == project_id).all()
-        document_ids = [x.document_id for x in document_relations]
-        documents = session.query(Document).filter(Document.document_id.in_(document_ids)).all()
-        # delete documents and document relations since documents are tighted to projects
-        documents.delete()
-        document_relations.delete()
-        # get user relations related to this project and delete
-        session.query(UserToProject).filter(UserToProject.project_id == project_id).all().delete()
-        session.commit()
+async def delete_project(project_id: int, access: Access = Depends(require_project_access("owner")), session: AsyncSession = Depends(get_session)):
+    if await session.scalar(select(Project.version).where(Project.project_id == project_id)) is None:
+        raise project_not_found()
+    # get document ids related to this project
+    document_ids = select(ProjectToDocument.document_id).where(ProjectToDocument.project_id == project_id)
+    document_ids = (await session.scalars(document_ids)).all()
+    # delete the documents, then the blobs no other document refers to
+    s3_keys = await release_documents(session, project_id, document_ids)
+    # members lose their access, so their tokens' access claims have to be ignored from now on
+    member_ids = (await session.scalars(select(UserToProject.user_id).where(UserToProject.project_id == project_id))).all()
+    await bump_generation(session, member_ids)
+    change = await announce_access_change(session, member_ids, project_id=project_id)
+    await add_to_summaries(session, member_deltas(project_id, projects=-1))
+    await emit_events(session, [{"project_id": project_id, "user_id": x, "kind": "project_deleted", "data": {}} for x in member_ids])
+    # delete user relations related to this project and the project itself
+    await session.execute(delete(UserToProject).where(UserToProject.project_id == project_id))
+    await session.execute(delete(Project).where(Project.project_id == project_id))
+    # the objects are deleted in the background once this transaction commits
+    job = enqueue_object_deletion(session, access.user_id, s3_keys)
+    await session.commit()
+    forget_access(change)
+    if job:
+        outbox_worker.wake()
+    return {"success": True, "job_id": job.job_id if job else None}
 
 # GET /project/<project_id>/documents- Return all of the project's documents
 @app.get("/project/{project_id}/documents")
-async def get_documents(project_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        # get user id
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        if not user:
-            raise HTTPException(
-                status_code=403,
-                detail="User couldn't find!",
+async def get_documents(project_id: int, request: Request, access: Access = Depends(require_project_access("participant")), session: AsyncSession = Depends(get_session)):
+    version = await session.scalar(select(Project.version).where(Project.project_id == project_id))
+    if version is None:
+        raise project_not_found()
+
+    async def build():
+        # get documents
+        # document_info only has what bumps the project's version when it changes
+        document_ids = select(ProjectToDocument.document_id).where(ProjectToDocument.project_id == project_id)
+        documents = await session.scalars(select(Document).where(Document.document_id.in_(document_ids)))
+        return [document_info(x) for x in documents]
+
+    return await conditional_json(request, access.user_id, project_etag(project_id, version), build)
+
+async def store_documents(session, project_id, files, request, replace=None):
+    # Every file becomes a document of its own, with its own name. The content is stored
+    # content addressed, the s3 key of a file is the sha256 of its content, and content
+    # that is already stored isn't sent to S3 again, its blob gets one more reference.
+    # Returns one result per file, in the same order as the files.
+    # `replace` is (document_id, user_id) of a document that is released in the same transaction
+    # (PUT /document), so an upload that fails or goes over the quota leaves it in place.
+    # No transaction is open while the files are sent to S3, a slow upload doesn't hold a pooled
+    # connection. The content is registered as pending uploads first, its objects stay until
+    # the documents are committed in a second short transaction.
+    slots = asyncio.Semaphore(S3_BATCH_CONCURRENCY)
+    # split the part slots between the files so that a batch holds
+    # no more parts in memory than a single upload
+    part_concurrency = max(1, S3_UPLOAD_CONCURRENCY // min(len(files), S3_BATCH_CONCURRENCY))
+
+    async def digest(file):
+        async with slots:
+            return await file_digest(file)
+
+    async def upload(file, s3_key):
+        async with slots:
+            size, etag = await multipart_upload(
+                get_s3(), BUCKET_NAME, s3_key, read_chunks(file),
+                part_size=S3_PART_SIZE, concurrency=part_concurrency,
+                is_disconnected=request.is_disconnected,
             )
-        user_id = user.user_id
-        # check access
-        relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-        if not relation:
-            raise HTTPException(
-                status_code=403,
-                detail="You don't have access to this project!",
+            return {"s3_key": s3_key, "size": size, "etag": etag}
+
+    digests = await asyncio.gather(*(digest(f) for f in files))
+    s3_keys = [x[0] for x in digests]
+    sizes = dict(digests)
+    # Every key is registered, the blob of stored content may be released before the documents
+    # are committed. Under the key locks, a blob that is being released is either gone already
+    # (and its content is sent again) or its object stays.
+    await lock_keys(session, s3_keys)
+    etags = dict((await session.execute(select(Blob.s3_key, Blob.etag).where(Blob.s3_key.in_(set(s3_keys))))).all())
+    registered = [PendingUpload(s3_key=x) for x in sorted(set(s3_keys))]
+    session.add_all(registered)
+    await session.commit()
+    # the same content is uploaded once, even if it is sent several times in the batch
+    pending = {}
+    for file, s3_key in zip(files, s3_keys):
+        if s3_key not in etags and s3_key not in pending:
+            pending[s3_key] = file
+    uploads = {}
+    job = None
+    deletion = None
+    try:
+        uploads = dict(zip(pending, await asyncio.gather(*(upload(f, k) for k, f in pending.items()), return_exceptions=True)))
+        etags.update((k, x["etag"]) for k, x in uploads.items() if isinstance(x, dict))
+        # a failed S3 call only fails its own file, anything else (e.g. the client going away) fails the batch
+        errors = [x for x in uploads.values() if isinstance(x, BaseException) and not isinstance(x, ClientError)]
+        if errors:
+            raise errors[0]
+        # The replaced document's key is locked too, in the same order as every other lock.
+        # release_documents takes the same locks, the blobs checked here stay until the commit.
+        replaced_key = None
+        if replace is not None:
+            replaced_key = await session.scalar(select(Document.s3_key).where(Document.document_id == replace[0]))
+        await lock_keys(session, [*s3_keys, *([replaced_key] if replaced_key else [])])
+        stored = set((await session.scalars(select(Blob.s3_key).where(Blob.s3_key.in_(etags)))).all())
+        # new content, or content whose blob was released while it was sent (its object stayed for
+        # the pending upload)
+        blobs = [
+            {"s3_key": x, "size": sizes[x], "etag": etags[x], "ref_count": 0, "processing_state": "pending"}
+            for x in etags if x not in stored
+        ]
+        if blobs:
+            await session.execute(insert(Blob).values(blobs))
+            # thumbnails and text are made in the background, the upload doesn't wait for them
+            job = enqueue_processing(session, [x["s3_key"] for x in blobs])
+        await session.execute(delete(PendingUpload).where(PendingUpload.upload_id.in_([x.upload_id for x in registered])))
+        documents = [Document(name=f.filename, s3_key=k) for f, k in zip(files, s3_keys) if k in etags]
+        if documents:
+            # one bulk insert for the documents and one for their relations
+            session.add_all(documents)
+            await session.flush()
+            references = Counter(x.s3_key for x in documents)
+            await session.execute(
+                update(Blob).where(Blob.s3_key.in_(references))
+                .values(ref_count=Blob.ref_count + case(references, value=Blob.s3_key))
             )
-        # get documents
-        relations = session.query(ProjectToDocument).filter(ProjectToDocument.project_id == project_id).all()
-        document_ids = [x.document_id for x in relations]
-        return session.query(Document).filter(Document.document_id.in_(document_ids)).all()
+            await session.execute(insert(ProjectToDocument).values([
+                {"project_id": project_id, "document_id": x.document_id, "size": sizes[x.s3_key]} for x in documents
+            ]))
+            total_bytes = await adjust_project_totals(session, project_id, len(documents), sum(sizes[x.s3_key] or 0 for x in documents))
+            await emit_events(session, [{"project_id": project_id, "kind": "document_added", "data": {"document_ids": sorted(x.document_id for x in documents)}}])
+            if replace is not None:
+                # released after the new document is stored, the new content may be the old document's blob
+                deletion = enqueue_object_deletion(session, replace[1], await release_documents(session, project_id, [replace[0]]))
+                await announce_access_change(session, document_id=replace[0])
+                total_bytes = await session.scalar(select(Project.total_bytes).where(Project.project_id == project_id))
+        if documents and PROJECT_QUOTA_BYTES and total_bytes > PROJECT_QUOTA_BYTES:
+            raise QuotaExceeded()
+        await session.commit()
+        if job or deletion:
+            outbox_worker.wake()
+    except BaseException:
+        # don't leave objects in the bucket that no document refers to
+        await session.rollback()
+        new_keys = [k for k, x in uploads.items() if isinstance(x, dict)]
+        # an upload of the same content may have written the object since,
+        # its blob or its pending upload is checked under the key locks
+        await lock_keys(session, new_keys)
+        await session.execute(delete(PendingUpload).where(PendingUpload.upload_id.in_([x.upload_id for x in registered])))
+        if new_keys:
+            referenced = await referenced_keys(session, new_keys)
+            await delete_objects(get_s3(), BUCKET_NAME, [x for x in new_keys if x not in referenced])
+        await session.commit()
+        raise
+
+    results = []
+    stored = iter(documents)
+    for file, s3_key in zip(files, s3_keys):
+        if s3_key in etags:
+            results.append({"name": file.filename, "success": True, "document_id": next(stored).document_id})
+        else:
+            print(uploads[s3_key])
+            results.append({"name": file.filename, "success": False, "detail": "Couldn't upload it to AWS!"})
+    return results
+
+async def release_documents(session, project_id, document_ids):
+    # Deletes the documents of the project. Blobs that no document refers to
+    # anymore are deleted, the keys of their objects are returned.
+    if not document_ids:
+        return []
+    unlinked = (await session.execute(
+        delete(ProjectToDocument)
+        .where(ProjectToDocument.project_id == project_id, ProjectToDocument.document_id.in_(document_ids))
+        .returning(ProjectToDocument.document_id, ProjectToDocument.size)
+    )).all()
+    if not unlinked:
+        return []
+    document_ids = [x.document_id for x in unlinked]
+    references = Counter((await session.scalars(
+        delete(Document).where(Document.document_id.in_(document_ids)).returning(Document.s3_key)
+    )).all())
+    # the keys are locked before the blobs and the project are, in the same order as uploads lock them
+    await lock_keys(session, references)
+    await session.execute(
+        update(Blob).where(Blob.s3_key.in_(references))
+        .values(ref_count=Blob.ref_count - case(references, value=Blob.s3_key))
+    )
+    deleted = await session.execute(
+        delete(Blob)
+        .where(Blob.s3_key.in_(references), Blob.ref_count <= 0)
+        .returning(Blob.s3_key, Blob.thumbnail_key, Blob.text_key)
+    )
+    await adjust_project_totals(session, project_id, -len(unlinked), -sum(x.size or 0 for x in unlinked))
+    await emit_events(session, [{"project_id": project_id, "kind": "document_removed", "data": {"document_ids": sorted(document_ids)}}])
+    return [key for row in deleted.all() for key in row if key]
 
 # POST /project/<project_id>/documents - Upload document/documents for a specific project
+# a single document is sent as "file", several documents as "files"
 @app.post("/project/{project_id}/documents")
-async def post_document(file: Annotated[bytes, File()], project_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        try:
-            # get user id
-            token = extract_token(authorization)
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-            if not user:
-                raise HTTPException(
-                    status_code=403,
-                    detail="User couldn't find!",
-                )
-            user_id = user.user_id
-            # check access
-            relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-            if not relation or relation.access_type != "owner":
-                raise HTTPException(
-                    status_code=403,
-                    detail="You don't have access to this project!",
-                )
-            # upload document
-            digestable = file.name + datetime.utcnow()
-            response = s3_client.upload_fileobj(file, bucket, hash_data(digestable))
-            session.add(Document(name=file.name,s3_key=hash_data(digestable)))
-            session.commit()
-            doc_id = session.query(Document).filter(Document.name == file.name and Document.s3_key == hash_data(digestable)).first().document_id
-            relation = ProjectToDocument(document_id=doc_id, project_id=project_id)
-            session.add(relation)
-            session.commit()
-            return {"success":True, "document_id":doc_id}
-        except ClientError as e:
-            print(e)
+async def post_document(project_id: int, request: Request, file: Annotated[UploadFile | None, File()] = None, files: Annotated[List[UploadFile] | None, File()] = None, access: Access = Depends(require_project_access("owner")), session: AsyncSession = Depends(get_session)):
+    if not file and not files:
+        raise HTTPException(
+            status_code=400,
+            detail="No file was given!"
+        )
+    results = await upload_documents(session, project_id, [file] if file else files, request)
+    if files:
+        return {"success": all(x["success"] for x in results), "documents": results}
+    if not results[0]["success"]:
+        raise HTTPException(
+            status_code=500,
+            detail="Couldn't upload it to AWS!"
+        )
+    return {"success":True, "document_id":results[0]["document_id"]}
+
+async def upload_documents(session, project_id, uploads, request, replace=None):
+    # shared by POST /project/<project_id>/documents and PUT /document/<document_id>,
+    # see store_documents for `replace`
+    total_bytes = await session.scalar(select(Project.total_bytes).where(Project.project_id == project_id))
+    if total_bytes is None:
+        raise project_not_found()
+    if PROJECT_QUOTA_BYTES:
+        # reject before anything is sent to S3, the form is already parsed so the sizes
+        # of the files are known, unlike Content-Length they don't include the multipart framing.
+        # store_documents checks the quota again against the counter it updates.
+        incoming = sum(x.size if x.size is not None else int(request.headers.get("content-length", 0)) for x in uploads)
+        if replace is not None:
+            # the replaced document's bytes are freed by the same upload
+            total_bytes -= await session.scalar(
+                select(func.coalesce(ProjectToDocument.size, 0))
+                .where(ProjectToDocument.project_id == project_id, ProjectToDocument.document_id == replace[0])
+            ) or 0
+        if total_bytes + incoming > PROJECT_QUOTA_BYTES:
             raise HTTPException(
-                status_code=500,
-                detail="Couldn't upload it to AWS!"
+                status_code=413,
+                detail="Project storage quota exceeded!"
             )
-        except HTTPException as e:
-            raise e
+    # the connection goes back to the pool while the files are hashed, see store_documents
+    await session.commit()
+    try:
+        # upload documents, every file is streamed to S3 part by part
+        return await store_documents(session, project_id, uploads, request, replace)
+    except QuotaExceeded:
+        raise HTTPException(
+            status_code=413,
+            detail="Project storage quota exceeded!"
+        )
+    except UploadAborted:
+        raise HTTPException(
+            status_code=400,
+            detail="Upload was aborted by the client!"
+        )
+    except ClientError as e:
+        print(e)
+        raise HTTPException(
+            status_code=500,
+            detail="Couldn't upload it to AWS!"
+        )
 
 # GET /document/<document_id> - Download document, if the user has access to the corresponding project
 @app.get("/document/{document_id}")
-async def download_document(document_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
+async def download_document(document_id: int, range: Annotated[str | None, Header()] = None, if_none_match: Annotated[str | None, Header()] = None, redirect: Optional[bool] = None, access: Access = Depends(require_document_access("participant")), session: AsyncSession = Depends(get_session)):
+    try:
+        document_sql_record = await session.get(Document, document_id)
+        if redirect if redirect is not None else DOWNLOAD_MODE == "redirect":
+            url = await run_in_threadpool(
+                get_s3().generate_presigned_url, "get_object",
+                Params={"Bucket": BUCKET_NAME, "Key": document_sql_record.s3_key,
+                        "ResponseContentDisposition": content_disposition(document_sql_record.name)},
+                ExpiresIn=PRESIGNED_URL_EXPIRES,
+            )
+            return RedirectResponse(url, status_code=307)
+        # Range and If-None-Match are answered by S3 itself
+        params = {"Bucket": BUCKET_NAME, "Key": document_sql_record.s3_key}
+        if range:
+            params["Range"] = range
+        if if_none_match:
+            params["IfNoneMatch"] = if_none_match
+        # a range reserves the whole document, its size is all that is known before S3 answers
+        reservation = reserve_download(document_sql_record.blob.size)
         try:
-            # get user id
-            token = extract_token(authorization)
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-            if not user:
-                raise HTTPException(
-                    status_code=403,
-                    detail="User couldn't find!",
-                )
-            user_id = user.user_id
-            # check access
-            temp = session.query(ProjectToDocument).filter(ProjectToDocument.document_id == document_id).first()
-            if not temp:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Document doesn't exist!",
-                )
-            project_id = temp.project_id
-            relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-            if not relation:
+            s3_object = await run_in_threadpool(get_s3().get_object, **params)
+        except ClientError as e:
+            reservation.release()
+            status_code = e.response["ResponseMetadata"]["HTTPStatusCode"]
+            if status_code == 304:
+                # the object's own ETag, If-None-Match may be a list of them or *
+                etag = e.response["ResponseMetadata"]["HTTPHeaders"].get("etag", document_sql_record.blob.etag)
+                return Response(status_code=304, headers={"ETag": etag} if etag else None)
+            if status_code == 416:
                 raise HTTPException(
-                    status_code=403,
-                    detail="You don't have access to this project!",
+                    status_code=416,
+                    detail="Requested range is not satisfiable!"
                 )
-            # upload document
-            document_sql_record = session.query(Document).filter(Document.document_id == relation.document_id).first()
-            with open("tempfile", 'wb') as f:
-                s3.download_fileobj(BUCKET_NAME, document_sql_record.s3_key, f)
-            return FileResponse(path="./tempfile", media_type='application/octet-stream', filename=document_sql_record.name)
-        except ClientError as e:
-            print(e)
-            raise HTTPException(
-                status_code=500,
-                detail="Couldn't upload it to AWS!"
-            )
-        except HTTPException as e:
-            raise e
+            raise
+        except BaseException:
+            reservation.release()
+            raise
+        headers = {
+            "Content-Length": str(s3_object["ContentLength"]),
+            "ETag": s3_object["ETag"],
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": content_disposition(document_sql_record.name),
+        }
+        if "ContentRange" in s3_object:
+            headers["Content-Range"] = s3_object["ContentRange"]
+        body, release = stream_reserved(stream_object(s3_object["Body"]), reservation)
+        return StreamingResponse(
+            body,
+            status_code=206 if "ContentRange" in s3_object else 200,
+            media_type="application/octet-stream",
+            headers=headers,
+            background=release,
+        )
+    except ClientError as e:
+        print(e)
+        raise HTTPException(
+            status_code=500,
+            detail="Couldn't download it from AWS!"
+        )
+
+def archive_paths(documents):
+    # file names in the export, without directories and unique within the archive
+    used = {EXPORT_MANIFEST_NAME}
+    paths = {}
+    for document in documents:
+        name = document.name.replace("/", "_").replace("\\", "_")
+        if not name.strip("."):
+            name = f"document-{document.document_id}"
+        if name in used:
+            stem, dot, extension = name.rpartition(".")
+            name = f"{stem} ({document.document_id}).{extension}" if stem else f"{name} ({document.document_id})"
+        used.add(name)
+        paths[document.document_id] = name
+    return paths
+
+async def prepend(first, chunks=None):
+    # the chunks with `first` in front of them
+    if first is not None:
+        yield first
+    if chunks is not None:
+        async for chunk in chunks:
+            yield chunk
+
+async def export_project(session, project_id, known):
+    # known is {document_id: etag} of what the client already has, those documents are left out
+    project = await session.get(Project, project_id)
+    if project is None:
+        raise project_not_found()
+    documents = (await session.execute(
+        select(Document.document_id, Document.name, Blob.s3_key, Blob.size, Blob.etag)
+        .join(Blob, Blob.s3_key == Document.s3_key)
+        .join(ProjectToDocument, ProjectToDocument.document_id == Document.document_id)
+        .where(ProjectToDocument.project_id == project_id)
+        .order_by(Document.document_id)
+    )).all()
+    # the archive can take long to send, it doesn't need the connection
+    await session.close()
+    paths = archive_paths(documents)
+    unchanged = [x.document_id for x in documents if x.document_id in known and known[x.document_id] == x.etag]
+    exported = [x for x in documents if x.document_id not in set(unchanged)]
+    exported_at = datetime.utcnow()
+    reservation = reserve_download(sum(x.size or 0 for x in exported))
+
+    async def entries():
+        missing = []
+        objects = prefetch_objects(get_s3(), BUCKET_NAME, [x.s3_key for x in exported], EXPORT_PREFETCH, EXPORT_BUFFERED_CHUNKS)
+        try:
+            remaining = iter(exported)
+            async for _, chunks in objects:
+                document = next(remaining)
+                # an object that can't be read is left out and listed in the manifest, a failure
+                # after its first bytes were sent ends the response and the client has to retry
+                try:
+                    first = await anext(chunks, None)
+                except (ClientError, BotoCoreError) as e:
+                    print(e)
+                    missing.append(document.document_id)
+                    continue
+                yield paths[document.document_id], document.size, exported_at, prepend(first, chunks)
+        finally:
+            await objects.aclose()
+        # POST it back to only get the documents that changed
+        manifest = json.dumps({
+            "project_id": project_id,
+            "exported_at": exported_at.isoformat(),
+            "documents": [
+                {"document_id": x.document_id, "name": x.name, "path": paths[x.document_id], "size": x.size, "etag": x.etag}
+                for x in documents if x.document_id not in missing
+            ],
+            "unchanged": unchanged,
+            "missing": missing,
+            "removed": sorted(set(known) - {x.document_id for x in documents}),
+        }, indent=2).encode("utf-8")
+        yield EXPORT_MANIFEST_NAME, len(manifest), exported_at, prepend(manifest)
+
+    body, release = stream_reserved(zip_stream(entries()), reservation)
+    return StreamingResponse(body, media_type="application/zip", background=release, headers={
+        "Content-Disposition": content_disposition(f"{project.name}.zip".replace("/", "_")),
+    })
+
+# GET /project/<project_id>/export - All of the project's documents as a ZIP archive, built while it is sent.
+# The archive ends with a manifest.json of the documents' ids and ETags.
+@app.get("/project/{project_id}/export")
+async def get_export(project_id: int, access: Access = Depends(require_project_access("participant")), session: AsyncSession = Depends(get_session)):
+    return await export_project(session, project_id, {})
+
+# POST /project/<project_id>/export - Same archive without the documents the client already has,
+# the body is the manifest.json of an earlier export (or of the files a broken download got through)
+@app.post("/project/{project_id}/export")
+async def post_export(project_id: int, manifest: ExportManifestModel, access: Access = Depends(require_project_access("participant")), session: AsyncSession = Depends(get_session)):
+    return await export_project(session, project_id, {x.document_id: x.etag for x in manifest.documents})
 
-# PUT /document/<document_id> - Update document
 @app.put("/document/{document_id}")
-async def put_document(file: Annotated[bytes, File()], document_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        relation = session.query(ProjectToDocument).filter(ProjectToDocument.document_id == document_id).first()
-        if not relation:
-            raise HTTPException(
-                status_code=400,
-                detail="Document doesn't exist!"
-            )
-        project_id = relation.project_id
-        delete_document(document_id)
-        post_document(file, project_id)
+async def put_document(file: UploadFile, document_id: int, request: Request, access: Access = Depends(require_document_access("owner")), session: AsyncSession = Depends(get_session)):
+    # the new file is stored and the old document released in one transaction,
+    # a rejected or failed upload leaves the old document in place
+    results = await upload_documents(session, access.project_id, [file], request, replace=(document_id, access.user_id))
+    if not results[0]["success"]:
+        raise HTTPException(
+            status_code=500,
+            detail="Couldn't upload it to AWS!"
+        )
+    forget_access({"document_id": document_id})
+    return {"success":True, "document_id":results[0]["document_id"]}
 
 # DELETE /document/<document_id> - Delete document and remove it from the corresponding project
 @app.delete("/document/{document_id}")
-async def delete_document(document_id: int, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        try:
-            # get user id
-            token = extract_token(authorization)
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-            if not user:
-                raise HTTPException(
-                    status_code=403,
-                    detail="User couldn't find!",
-                )
-            user_id = user.user_id
-            # check access
-            temp = session.query(ProjectToDocument).filter(ProjectToDocument.document_id == document_id).first()
-            if not temp:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Document doesn't exist!",
-                )
-            project_id = temp.project_id
-            relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-            if not relation or relation.access_type != "owner":
-                raise HTTPException(
-                    status_code=403,
-                    detail="You don't have access to this project!",
-                )
-            # delete document
-            document_sql_record = session.query(Document).filter(Document.document_id == document_id).first()
-            document_relation = session.query(ProjectToDocument).filter(ProjectToDocument.document_id == document_id).first()
-            session.delete(document_sql_record)
-            session.delete(document_relation)
-            session.commit()
-            s3.delete_object(Bucket=BUCKET_NAME, Key=document_sql_record.s3_key)
-            return {"success": True}
-        except ClientError as e:
-            print(e)
-            raise HTTPException(
-                status_code=500,
-                detail="Couldn't upload it to AWS!"
-            )
-        except HTTPException as e:
-            raise e
+async def delete_document(document_id: int, access: Access = Depends(require_document_access("owner")), session: AsyncSession = Depends(get_session)):
+    # remove the document from the project, its object is deleted
+    # only if no other document has the same content
+    s3_keys = await release_documents(session, access.project_id, [document_id])
+    job = enqueue_object_deletion(session, access.user_id, s3_keys)
+    change = await announce_access_change(session, document_id=document_id)
+    await session.commit()
+    forget_access(change)
+    if job:
+        outbox_worker.wake()
+    return {"success": True, "job_id": job.job_id if job else None}
+
+async def change_members(session, project_id, changes, user_id, add_only=False):
+    # changes is {login: access_type}. All logins are resolved with one query and all
+    # memberships are written with one upsert. With add_only existing members are left as they are.
+    # Returns the result of every login and the access change to pass to forget_access, None if nothing changed.
+    # Bumping the version first takes the project's row lock, so membership changes
+    # of the same project run one after another and the rows read below stay valid.
+    if await session.scalar(
+        update(Project).where(Project.project_id == project_id).values(version=Project.version + 1).returning(Project.project_id)
+    ) is None:
+        raise project_not_found()
+    rows = (await session.execute(
+        select(UserTable.login, UserTable.user_id, UserToProject.access_type)
+        .select_from(UserTable)
+        .outerjoin(UserToProject, and_(UserToProject.user_id == UserTable.user_id, UserToProject.project_id == project_id))
+        .where(UserTable.login.in_(changes))
+    )).all()
+    found = {x.login: x for x in rows}
+    results = []
+    upserts = []
+    added = []
+    events = []
+    for login, access_type in changes.items():
+        row = found.get(login)
+        if row is None:
+            results.append({"login": login, "success": False, "detail": "User couldn't find!"})
+        elif row.user_id == user_id:
+            results.append({"login": login, "success": False, "detail": "You can't change your own access!"})
+        elif row.access_type == access_type or (add_only and row.access_type):
+            results.append({"login": login, "success": True, "access_type": row.access_type, "status": "unchanged"})
+        else:
+            upserts.append({"user_id": row.user_id, "project_id": project_id, "access_type": access_type})
+            if row.access_type is None:
+                added.append(row.user_id)
+            status = "added" if row.access_type is None else "updated"
+            results.append({"login": login, "success": True, "access_type": access_type, "status": status})
+            events.append({
+                "project_id": project_id, "kind": "member_invited" if row.access_type is None else "member_updated",
+                "data": {"user_id": row.user_id, "login": login, "access_type": access_type},
+            })
+    if upserts:
+        statement = pg_insert(UserToProject).values(upserts)
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=[UserToProject.user_id, UserToProject.project_id],
+            set_={"access_type": statement.excluded.access_type},
+        ))
+        if added:
+            await add_to_summaries(session, select(
+                UserToProject.user_id, literal(1, Integer), Project.document_count, Project.total_bytes
+            ).join(Project, Project.project_id == UserToProject.project_id).where(
+                UserToProject.project_id == project_id, UserToProject.user_id.in_(added)
+            ))
+        await bump_generation(session, [x["user_id"] for x in upserts])
+        await emit_events(session, events)
+    return results, await announce_access_change(session, [x["user_id"] for x in upserts], project_id=project_id) if upserts else None
 
 # POST /project/<project_id>/invite?user= - Grant access to the project for a specific user.
 # If the request is not coming from the owner of the project, results in error.,
 # Granting access gives participant permissions to receiving user
-@app.post("/project/{project_id}/invite?user={username}")
-async def invite_to_project(project_id: int, username: str, authorized: bool = Depends(verify_token), authorization: Annotated[str | None, Header()] = None):
-    if authorized:
-        # get user id
-        token = extract_token(authorization)
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.query(UserTable).filter(UserTable.login == payload["login"]).first()
-        if not user:
-            raise HTTPException(
-                status_code=403,
-                detail="User couldn't find!",
-            )
-        user_id = user.user_id
-        # check access
-        relation = session.query(UserToProject).filter(UserToProject.user_id == user_id and UserToProject.project_id == project_id).first()
-        if not relation or relation.access_type != "owner":
-            raise HTTPException(
-                status_code=403,
-                detail="You don't have owner access to this project!",
-            )
-        # invite implementation
-        # Step 1 - Get user id of the invited user
-        invited_user = session.query(UserTable).filter(UserTable.login == username).first()
-        new_relation = UserToProject(user_id=invited_user.user_id,project_id=project_id,access_type="participant")
-        session.add(new_relation)
-        session.commit()
-
-# Run with: uvicorn app.main:app --reload
\ No newline at end of file
+@app.post("/project/{project_id}/invite")
+async def invite_to_project(project_id: int, user: str, access: Access = Depends(require_project_access("owner")), session: AsyncSession = Depends(get_session)):
+    results, changed = await change_members(session, project_id, {user: "participant"}, access.user_id, add_only=True)
+    await session.commit()
+    if changed:
+        forget_access(changed)
+    if not results[0]["success"]:
+        raise HTTPException(
+            status_code=400,
+            detail=results[0]["detail"],
+        )
+    return results[0]
+
+# POST /project/<project_id>/members - Add members or change their access in one go, only for the owner.
+# Body: {"members": [{"login": ..., "access_type": "participant" or "owner"}, ...]},
+# returns the result of every login, logins that failed don't stop the others.
+@app.post("/project/{project_id}/members")
+async def post_members(project_id: int, model: MembersModel, access: Access = Depends(require_project_access("owner")), session: AsyncSession = Depends(get_session)):
+    if len(model.members) > MEMBERS_MAX_BATCH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MEMBERS_MAX_BATCH} members can be changed at once!",
+        )
+    # the last entry of a login that is listed more than once wins
+    changes = {x.login: x.access_type for x in model.members}
+    results, changed = await change_members(session, project_id, changes, access.user_id)
+    # one transaction and one cache invalidation for the whole batch
+    await session.commit()
+    if changed:
+        forget_access(changed)
+    return {"success": all(x["success"] for x in results), "members": results}
+
+# GET /events - Server-sent events about the user's projects: project_updated, project_deleted,
+# document_added, document_removed, member_invited, member_updated.
+# The token is checked once, the stream ends when it expires. Reconnect with Last-Event-ID
+# (or ?last_event_id=) to get the events that were missed, a "resync" event means they
+# couldn't all be replayed and the client should load everything again.
+@app.get("/events")
+async def get_events(last_event_id: Optional[int] = None, last_event_id_header: Annotated[str | None, Header(alias="Last-Event-ID")] = None, payload: dict = Depends(verify_token)):
+    if last_event_id is None and last_event_id_header and last_event_id_header.isdigit():
+        last_event_id = int(last_event_id_header)
+    # no session dependency, it would hold a pooled connection for as long as the stream is open
+    async with Session() as session:
+        project_ids = (await session.scalars(
+            select(UserToProject.project_id).where(UserToProject.user_id == payload["user_id"])
+        )).all()
+        if last_event_id is None:
+            last_event_id = await session.scalar(select(func.coalesce(func.max(ProjectEvent.event_id), 0)))
+    subscriber = event_hub.subscribe(payload["user_id"], project_ids)
+    expires_at = payload["exp"]
+
+    async def stream():
+        nonlocal last_event_id
+        try:
+            yield "retry: 3000\n\n"
+            # subscribed before replaying, so nothing falls between the replay and the live events
+            pending = [RESYNC]
+            while True:
+                for event in pending:
+                    if event is RESYNC:
+                        # shielded, a client disconnecting mid-query would leave the connection checked out
+                        events, newest = await asyncio.shield(replay_events(subscriber, last_event_id))
+                        if events is None:
+                            last_event_id = newest
+                            events = []
+                            yield "event: resync\ndata: {}\n\n"
+                    else:
+                        events = [event]
+                    for event in events:
+                        if event["id"] <= last_event_id:
+                            continue
+                        if event["kind"] == "project_deleted":
+                            subscriber.project_ids.discard(event["project_id"])
+                        last_event_id = event["id"]
+                        metrics.events_sent.inc()
+                        yield sse_message(event)
+                timeout = min(EVENTS_HEARTBEAT, expires_at - time.time())
+                if timeout <= 0:
+                    break
+                try:
+                    pending = [await asyncio.wait_for(subscriber.queue.get(), timeout)]
+                except asyncio.TimeoutError:
+                    pending = []
+                    yield ": heartbeat\n\n"
+        finally:
+            event_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # nginx would otherwise buffer the stream
+        "X-Accel-Buffering": "no",
+    })
+
+# GET /metrics - Prometheus metrics of this process
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# GET /jobs/metrics - Depth of the background job queue and counters of this process' worker
+@app.get("/jobs/metrics")
+async def get_job_metrics(session: AsyncSession = Depends(get_session)):
+    counts = dict((await session.execute(select(OutboxJob.status, func.count()).group_by(OutboxJob.status))).all())
+    oldest = await session.scalar(select(func.min(OutboxJob.created_at)).where(OutboxJob.status == "pending"))
+    return {
+        "pending": counts.get("pending", 0),
+        "failed": counts.get("failed", 0),
+        "done": counts.get("done", 0),
+        "oldest_pending_seconds": (datetime.utcnow() - oldest).total_seconds() if oldest else 0,
+        "worker": outbox_worker.stats,
+    }
+
+# GET /jobs/<job_id> - Status of a background job started by the user
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: int, payload: dict = Depends(verify_token), session: AsyncSession = Depends(get_session)):
+    job = await session.get(OutboxJob, job_id)
+    if not job or job.user_id != payload["user_id"]:
+        raise HTTPException(
+            status_code=400,
+            detail="Job doesn't exist!",
+        )
+    return {
+        "job_id": job.job_id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "remaining": len(job.payload["keys"]) if job.status != "done" else 0,
+        "last_error": job.last_error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+# Run with: uvicorn app.main:app --reload
+# Create the tables (and add the missing columns and indexes to existing ones) and the bucket with: python main.py migrate
+# Recompute project totals and user summaries with: python main.py rebuild-summaries
+# Fix document sizes from the bucket and recompute the totals with: python main.py reconcile-storage
+if __name__ == "__main__":
+    commands = {"migrate": migrate, "rebuild-summaries": rebuild_summaries, "reconcile-storage": reconcile_storage}
+    if len(sys.argv) == 2 and sys.argv[1] in commands:
+        asyncio.run(commands[sys.argv[1]]())
+    else:
+        print(f"usage: python main.py {'|'.join(commands)}")
+        sys.exit(2)
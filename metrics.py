@@ -0,0 +1,231 @@
+# Request level performance instrumentation
+# Histograms and counters are kept per process and exposed in the Prometheus
+# text format by GET /metrics, with several uvicorn workers every worker is scraped
+# separately. SQL statements and S3 calls are attributed to the request they run in
+# through a context variable, this also works for code running in the threadpool
+# and in SQLAlchemy's greenlets since both copy the context of the caller.
+
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_statements = 0
+        self.db_seconds = 0.0
+        self.s3_calls = 0
+        self.s3_seconds = 0.0
+        self.s3_bytes = 0
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {series[-1]}")
+        return lines
+
+
+http_duration = Histogram(
+    "http_request_duration_seconds", "Time until the response started, per route template",
+    labels=("method", "route", "status"),
+)
+http_db_statements = Histogram(
+    "http_request_db_statements", "SQL statements executed per request",
+    labels=("method", "route"), buckets=COUNT_BUCKETS,
+)
+http_db_duration = Histogram(
+    "http_request_db_duration_seconds", "Time spent in SQL statements per request",
+    labels=("method", "route"),
+)
+http_s3_calls = Histogram(
+    "http_request_s3_calls", "S3 calls made per request",
+    labels=("method", "route"), buckets=COUNT_BUCKETS,
+)
+db_duration = Histogram("db_statement_duration_seconds", "Duration of single SQL statements")
+db_slow_statements = Counter("db_slow_statements_total", "SQL statements slower than the slow query threshold")
+s3_duration = Histogram("s3_call_duration_seconds", "Duration of S3 calls", labels=("operation",))
+s3_bytes = Counter("s3_bytes_total", "Bytes sent to and received from S3", labels=("operation", "direction"))
+response_cache_requests = Counter(
+    "response_cache_requests_total", "Conditional reads answered with 304, from the response cache or built",
+    labels=("result",),
+)
+events_subscribers = Gauge("events_subscribers", "Open GET /events streams of this worker")
+events_received = Counter("events_received_total", "Change notifications received through LISTEN")
+events_sent = Counter("events_sent_total", "Events sent to GET /events streams")
+events_resyncs = Counter("events_resyncs_total", "Streams that fell behind and caught up from the database")
+rate_limit_requests = Counter(
+    "rate_limit_requests_total", "Requests of the rate limited route classes, admitted or limited (429)",
+    labels=("route_class", "result"),
+)
+transfer_rejections = Counter(
+    "transfer_rejections_total", "Transfers turned away (503) because the worker's byte budget was used up",
+    labels=("direction",),
+)
+transfer_bytes_in_flight = Gauge(
+    "transfer_bytes_in_flight", "Bytes reserved by the uploads and downloads running in this worker",
+    labels=("direction",),
+)
+startup_seconds = Gauge(
+    "app_startup_seconds", "Time this worker took to import main and to get through the lifespan startup",
+    labels=("phase",),
+)
+
+REGISTRY = [
+    http_duration, http_db_statements, http_db_duration, http_s3_calls,
+    db_duration, db_slow_statements, s3_duration, s3_bytes, response_cache_requests,
+    events_subscribers, events_received, events_sent, events_resyncs,
+    rate_limit_requests, transfer_rejections, transfer_bytes_in_flight, startup_seconds,
+]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def observe_request(stats, method, route, status):
+    http_duration.observe(time.perf_counter() - stats.started, method, route, status)
+    http_db_statements.observe(stats.db_statements, method, route)
+    http_db_duration.observe(stats.db_seconds, method, route)
+    http_s3_calls.observe(stats.s3_calls, method, route)
+
+
+def server_timing(stats):
+    total = time.perf_counter() - stats.started
+    return (
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.db_statements} statements", '
+        f's3;dur={stats.s3_seconds * 1000:.1f};desc="{stats.s3_calls} calls", '
+        f'total;dur={total * 1000:.1f}'
+    )
+
+
+def instrument_engine(engine, slow_query_threshold):
+    # slow_query_threshold in seconds, statements that take longer are printed
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context._metrics_started
+        db_duration.observe(duration)
+        stats = current_request.get()
+        if stats is not None:
+            stats.db_statements += 1
+            stats.db_seconds += duration
+        if duration > slow_query_threshold:
+            db_slow_statements.inc()
+            print(f"slow query ({duration * 1000:.1f} ms): {' '.join(statement.split())}")
+
+
+def body_size(body):
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if hasattr(body, "seek") and hasattr(body, "tell"):
+        # botocore wraps the body in a file object, measure what is left to send
+        position = body.tell()
+        size = body.seek(0, 2) - position
+        body.seek(position)
+        return size
+    return 0
+
+
+def instrument_s3(client):
+    def before_call(model, params, context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+        context["metrics_sent"] = body_size(params.get("body"))
+
+    def after_call(model, parsed, context, **kwargs):
+        started = context.get("metrics_started")
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        received = parsed.get("ContentLength", 0) if isinstance(parsed, dict) else 0
+        s3_duration.observe(duration, model.name)
+        s3_bytes.inc(model.name, "sent", amount=context["metrics_sent"])
+        s3_bytes.inc(model.name, "received", amount=received)
+        stats = current_request.get()
+        if stats is not None:
+            stats.s3_calls += 1
+            stats.s3_seconds += duration
+            stats.s3_bytes += context["metrics_sent"] + received
+
+    client.meta.events.register("before-call.s3", before_call)
+    client.meta.events.register("after-call.s3", after_call)
@@ -0,0 +1,188 @@
+# Password hashing used by POST /auth and POST /login
+# Hashing with a memory-hard KDF takes tens of milliseconds of CPU on purpose,
+# so it runs in a bounded executor and never on the event loop.
+# scrypt comes with hashlib, argon2 (argon2-cffi) and bcrypt are optional.
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def b64decode(data):
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class LegacySha256Hasher:
+    # unsalted sha256 hex digests stored before the KDFs were introduced,
+    # only used to verify them so that they can be rehashed on login
+    scheme = "sha256"
+
+    def identify(self, stored):
+        return len(stored) == 64 and all(c in "0123456789abcdef" for c in stored)
+
+    def verify(self, password, stored):
+        return hmac.compare_digest(hashlib.sha256(password.encode("utf-8")).hexdigest(), stored)
+
+    def needs_rehash(self, stored):
+        return True
+
+
+class ScryptHasher:
+    # stored as scrypt$<n>$<r>$<p>$<salt>$<hash>
+    scheme = "scrypt"
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def derive(self, password, salt, n, r, p):
+        # maxmem has to fit 128 * n * r bytes plus some room
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * n * r * 2, dklen=32)
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        key = self.derive(password, salt, self.n, self.r, self.p)
+        return f"scrypt${self.n}${self.r}${self.p}${b64encode(salt)}${b64encode(key)}"
+
+    def identify(self, stored):
+        return stored.startswith("scrypt$")
+
+    def verify(self, password, stored):
+        _, n, r, p, salt, key = stored.split("$")
+        derived = self.derive(password, b64decode(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(derived, b64decode(key))
+
+    def needs_rehash(self, stored):
+        _, n, r, p, _, _ = stored.split("$")
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+
+
+class Argon2Hasher:
+    scheme = "argon2"
+
+    def __init__(self, time_cost=3, memory_cost=64 * 1024, parallelism=1):
+        import argon2
+        self.time_cost = time_cost
+        self.memory_cost = memory_cost
+        self.parallelism = parallelism
+        self.hasher = argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+    def __getstate__(self):
+        # argon2.PasswordHasher is rebuilt in the worker process
+        return {"time_cost": self.time_cost, "memory_cost": self.memory_cost, "parallelism": self.parallelism}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def hash(self, password):
+        return self.hasher.hash(password)
+
+    def identify(self, stored):
+        return stored.startswith("$argon2")
+
+    def verify(self, password, stored):
+        import argon2
+        try:
+            return self.hasher.verify(stored, password)
+        except argon2.exceptions.VerificationError:
+            return False
+
+    def needs_rehash(self, stored):
+        return self.hasher.check_needs_rehash(stored)
+
+
+class BcryptHasher:
+    scheme = "bcrypt"
+
+    def __init__(self, rounds=12):
+        self.rounds = rounds
+
+    def hash(self, password):
+        import bcrypt
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(self.rounds)).decode("ascii")
+
+    def identify(self, stored):
+        return stored.startswith(("$2a$", "$2b$", "$2y$"))
+
+    def verify(self, password, stored):
+        import bcrypt
+        return bcrypt.checkpw(password.encode("utf-8"), stored.encode("ascii"))
+
+    def needs_rehash(self, stored):
+        return int(stored.split("$")[2]) != self.rounds
+
+
+def hasher_from_env():
+    scheme = os.environ.get("PASSWORD_HASHER", "scrypt")
+    if scheme == "scrypt":
+        return ScryptHasher(
+            n=int(os.environ.get("SCRYPT_N", str(2 ** 14))),
+            r=int(os.environ.get("SCRYPT_R", "8")),
+            p=int(os.environ.get("SCRYPT_P", "1")),
+        )
+    if scheme == "argon2":
+        return Argon2Hasher(
+            time_cost=int(os.environ.get("ARGON2_TIME_COST", "3")),
+            memory_cost=int(os.environ.get("ARGON2_MEMORY_COST", str(64 * 1024))),
+            parallelism=int(os.environ.get("ARGON2_PARALLELISM", "1")),
+        )
+    if scheme == "bcrypt":
+        return BcryptHasher(rounds=int(os.environ.get("BCRYPT_ROUNDS", "12")))
+    raise ValueError(f"Unknown PASSWORD_HASHER {scheme}")
+
+
+class PasswordContext:
+    # new passwords are hashed with `hasher`, stored hashes of any known scheme
+    # can be verified and are replaced when they don't match the current settings
+    def __init__(self, hasher, workers=None, executor="thread"):
+        self.hasher = hasher
+        self.schemes = [hasher, LegacySha256Hasher(), ScryptHasher(), BcryptHasher()]
+        try:
+            self.schemes.append(Argon2Hasher())
+        except ImportError:
+            pass
+        # verified instead when the login doesn't exist, see verify_unknown
+        self.dummy_hash = None
+        workers = workers or os.cpu_count() or 1
+        if executor == "process":
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+
+    def find_scheme(self, stored):
+        for scheme in self.schemes:
+            if scheme.identify(stored):
+                return scheme
+        return None
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def hash(self, password):
+        return await self.run(self.hasher.hash, password)
+
+    async def verify(self, password, stored):
+        # returns (matches, new hash to store or None)
+        scheme = self.find_scheme(stored)
+        if scheme is None or not await self.run(scheme.verify, password, stored):
+            return False, None
+        if scheme.scheme != self.hasher.scheme or scheme.needs_rehash(stored):
+            return True, await self.hash(password)
+        return True, None
+
+    async def verify_unknown(self, password):
+        # for logins that don't exist, runs the same KDF as verifying an existing user
+        # so that logins can't be found out from the response time
+        if self.dummy_hash is None:
+            self.dummy_hash = await self.hash(b64encode(os.urandom(16)))
+        await self.run(self.hasher.verify, password, self.dummy_hash)
+        return False, None
@@ -0,0 +1,81 @@
+# Document processing run by OutboxWorker after an upload has been committed
+# process() runs in a process pool, it gets the file's content and returns
+# what is stored on the document: its kind, page count, extracted text and a thumbnail.
+# Pillow (thumbnails) and pypdf (PDF text) are imported on first use so that
+# importing main stays cheap, DOCX files are read with the standard library.
+
+import io
+import re
+import zipfile
+from xml.etree import ElementTree
+
+THUMBNAIL_SIZE = (256, 256)
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+APP_NAMESPACE = "{http://schemas.openxmlformats.org/officeDocument/2006/extended-properties}"
+
+IMAGE_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a", b"BM")
+
+
+def detect_kind(data):
+    if data.startswith(b"%PDF-"):
+        return "pdf"
+    if data.startswith(IMAGE_SIGNATURES) or (data[:4] == b"RIFF" and data[8:12] == b"WEBP"):
+        return "image"
+    if data.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                if "word/document.xml" in archive.namelist():
+                    return "docx"
+        except zipfile.BadZipFile:
+            pass
+    return None
+
+
+def pdf_info(data):
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    text = "\n".join(page.extract_text() or "" for page in reader.pages)
+    return len(reader.pages), text
+
+
+def docx_info(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        document = ElementTree.fromstring(archive.read("word/document.xml"))
+        # the page count is only known to Word, it is saved in docProps/app.xml
+        page_count = None
+        if "docProps/app.xml" in archive.namelist():
+            pages = ElementTree.fromstring(archive.read("docProps/app.xml")).find(f"{APP_NAMESPACE}Pages")
+            if pages is not None and pages.text and pages.text.isdigit():
+                page_count = int(pages.text)
+    paragraphs = []
+    for paragraph in document.iter(f"{WORD_NAMESPACE}p"):
+        paragraphs.append("".join(x.text or "" for x in paragraph.iter(f"{WORD_NAMESPACE}t")))
+    return page_count, "\n".join(paragraphs)
+
+
+def thumbnail(data):
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        output = io.BytesIO()
+        image.save(output, format="PNG", optimize=True)
+        return output.getvalue()
+
+
+def process(data):
+    # returns {"kind", "page_count", "text", "thumbnail"}, the values are None
+    # for what doesn't apply to the file's kind
+    result = {"kind": detect_kind(data), "page_count": None, "text": None, "thumbnail": None}
+    if result["kind"] == "pdf":
+        result["page_count"], result["text"] = pdf_info(data)
+    elif result["kind"] == "docx":
+        result["page_count"], result["text"] = docx_info(data)
+    elif result["kind"] == "image":
+        result["thumbnail"] = thumbnail(data)
+    if result["text"] is not None:
+        # collapse the runs of blank lines the extractors leave behind
+        result["text"] = re.sub(r"\n{3,}", "\n\n", result["text"]).strip()
+    return result
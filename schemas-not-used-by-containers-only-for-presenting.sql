@@ -1,21 +1,55 @@
 CREATE TABLE user_table (
     user_id SERIAL PRIMARY KEY,
     login varchar(50) UNIQUE NOT NULL,
-    password_hash varchar NOT NULL
+    password_hash varchar NOT NULL,
+    token_generation integer NOT NULL DEFAULT 0
 );
 
 CREATE TABLE project (
     project_id SERIAL PRIMARY KEY,
     name varchar(100) UNIQUE NOT NULL,
-    description varchar(500)
+    description varchar(500),
+    document_count integer NOT NULL DEFAULT 0,
+    total_bytes bigint NOT NULL DEFAULT 0,
+    version integer NOT NULL DEFAULT 0,
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED
 );
 
+CREATE INDEX ix_project_search ON project USING gin (search_vector);
+
+CREATE TABLE blob (
+    s3_key varchar PRIMARY KEY,
+    size bigint,
+    etag varchar(100),
+    ref_count integer NOT NULL DEFAULT 0,
+    processing_state varchar(12),
+    content_kind varchar(12),
+    page_count integer,
+    thumbnail_key varchar,
+    text_key varchar,
+    content_text text,
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(content_text, '')), 'C')
+    ) STORED
+);
+
+CREATE INDEX ix_blob_search ON blob USING gin (search_vector);
+
 CREATE TABLE document (
     document_id SERIAL PRIMARY KEY,
-    s3_key varchar UNIQUE NOT NULL,
-    name varchar(150) NOT NULL
+    s3_key varchar NOT NULL REFERENCES blob (s3_key),
+    name varchar(150) NOT NULL,
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', translate(coalesce(name, ''), '._-', '   ')), 'A')
+    ) STORED
 );
 
+CREATE INDEX ix_document_s3_key ON document (s3_key);
+CREATE INDEX ix_document_search ON document USING gin (search_vector);
+
 CREATE TABLE user2project (
     user_id integer NOT NULL,
     project_id integer NOT NULL,
@@ -23,8 +57,61 @@ CREATE TABLE user2project (
     PRIMARY KEY(user_id, project_id)
 );
 
+CREATE INDEX ix_user2project_project_id ON user2project (project_id);
+
 CREATE TABLE project2document (
     project_id integer NOT NULL,
     document_id integer NOT NULL,
+    size bigint,
     PRIMARY KEY(project_id, document_id)
+);
+
+CREATE INDEX ix_project2document_document_id ON project2document (document_id);
+
+CREATE TABLE user_project_summary (
+    user_id integer PRIMARY KEY,
+    project_count integer NOT NULL,
+    document_count integer NOT NULL,
+    total_bytes bigint NOT NULL
+);
+
+CREATE TABLE outbox (
+    job_id SERIAL PRIMARY KEY,
+    kind varchar(30) NOT NULL,
+    payload json NOT NULL,
+    user_id integer,
+    status varchar(12) NOT NULL,
+    attempts integer NOT NULL,
+    last_error text,
+    created_at timestamp NOT NULL,
+    available_at timestamp NOT NULL,
+    finished_at timestamp
+);
+
+CREATE INDEX ix_outbox_pending ON outbox (available_at) WHERE status = 'pending';
+
+CREATE TABLE project_event (
+    event_id SERIAL PRIMARY KEY,
+    project_id integer NOT NULL,
+    user_id integer,
+    kind varchar(30) NOT NULL,
+    data json NOT NULL,
+    created_at timestamp NOT NULL
+);
+
+CREATE INDEX ix_project_event_user_id ON project_event (user_id);
+CREATE INDEX ix_project_event_created_at ON project_event (created_at);
+
+CREATE TABLE pending_upload (
+    upload_id SERIAL PRIMARY KEY,
+    s3_key varchar NOT NULL,
+    created_at timestamp NOT NULL
+);
+
+CREATE INDEX ix_pending_upload_s3_key ON pending_upload (s3_key);
+
+CREATE TABLE rate_limit (
+    key varchar(200) PRIMARY KEY,
+    tokens double precision NOT NULL,
+    updated_at timestamp NOT NULL
 );
\ No newline at end of file
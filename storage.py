@@ -0,0 +1,207 @@
+# S3 transfer helpers used by the routes in main.py
+# boto3 is blocking, so every call to S3 runs in the threadpool
+# and never on the event loop
+
+import asyncio
+import hashlib
+from collections import deque
+from urllib.parse import quote
+from fastapi.concurrency import run_in_threadpool
+from botocore.exceptions import BotoCoreError, ClientError
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# size of a single read from the incoming upload / from S3 while downloading
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadAborted(Exception):
+    pass
+
+
+async def read_chunks(file, chunk_size=READ_CHUNK_SIZE):
+    # async generator over an UploadFile, never holds more than one chunk
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def file_digest(file, chunk_size=READ_CHUNK_SIZE):
+    # sha256 and size of an UploadFile, read chunk by chunk,
+    # the file is rewound afterwards so that it can be uploaded
+    digest = hashlib.sha256()
+    size = 0
+    async for chunk in read_chunks(file, chunk_size):
+        await run_in_threadpool(digest.update, chunk)
+        size += len(chunk)
+    await file.seek(0)
+    return digest.hexdigest(), size
+
+
+async def multipart_upload(s3, bucket, key, chunks, part_size, concurrency, is_disconnected=None):
+    # Streams chunks into S3 and returns (size, etag) of the stored object.
+    # At most `concurrency` parts of `part_size` bytes are held in memory at once,
+    # reading from the client waits until one of the running part uploads finishes.
+    # Files smaller than one part are stored with a single put_object.
+    part_size = max(part_size, MIN_PART_SIZE)
+    slots = asyncio.Semaphore(concurrency)
+    buffer = bytearray()
+    size = 0
+    upload_id = None
+    tasks = []
+
+    async def upload_part(part_number, body):
+        try:
+            response = await run_in_threadpool(
+                s3.upload_part, Bucket=bucket, Key=key, UploadId=upload_id,
+                PartNumber=part_number, Body=body,
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            slots.release()
+
+    async def start_part(body):
+        nonlocal upload_id
+        if upload_id is None:
+            response = await run_in_threadpool(s3.create_multipart_upload, Bucket=bucket, Key=key)
+            upload_id = response["UploadId"]
+        await slots.acquire()
+        tasks.append(asyncio.create_task(upload_part(len(tasks) + 1, body)))
+
+    try:
+        async for chunk in chunks:
+            buffer += chunk
+            size += len(chunk)
+            while len(buffer) >= part_size:
+                if is_disconnected is not None and await is_disconnected():
+                    raise UploadAborted()
+                body = bytes(buffer[:part_size])
+                del buffer[:part_size]
+                await start_part(body)
+            # surface a failed part right away instead of after reading the whole file
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+
+        if upload_id is None:
+            response = await run_in_threadpool(s3.put_object, Bucket=bucket, Key=key, Body=bytes(buffer))
+            return size, response["ETag"]
+
+        if buffer:
+            await start_part(bytes(buffer))
+        parts = await asyncio.gather(*tasks)
+        response = await run_in_threadpool(
+            s3.complete_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        return size, response["ETag"]
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if upload_id is not None:
+            await run_in_threadpool(s3.abort_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+async def delete_objects(s3, bucket, keys):
+    # delete_objects accepts at most 1000 keys per call,
+    # returns {key: error} for the keys that couldn't be deleted
+    errors = {}
+    for i in range(0, len(keys), 1000):
+        batch = keys[i:i + 1000]
+        try:
+            response = await run_in_threadpool(
+                s3.delete_objects, Bucket=bucket,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+        except (ClientError, BotoCoreError) as e:
+            errors.update((key, str(e)) for key in batch)
+            continue
+        for error in response.get("Errors", []):
+            errors[error["Key"]] = f"{error.get('Code')}: {error.get('Message')}"
+    return errors
+
+
+async def list_objects(s3, bucket, page_size=1000):
+    # async generator over the pages of list_objects_v2, every page is a list of
+    # {"Key", "Size", ...} dicts with at most page_size entries
+    params = {"Bucket": bucket, "MaxKeys": page_size}
+    while True:
+        response = await run_in_threadpool(s3.list_objects_v2, **params)
+        yield response.get("Contents", [])
+        if not response.get("IsTruncated"):
+            break
+        params["ContinuationToken"] = response["NextContinuationToken"]
+
+
+async def stream_object(body, chunk_size=READ_CHUNK_SIZE):
+    # async generator over the StreamingBody of get_object,
+    # the body is closed even if the client goes away in the middle
+    try:
+        while True:
+            chunk = await run_in_threadpool(body.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
+
+
+async def prefetch_objects(s3, bucket, keys, prefetch, buffered_chunks):
+    # async generator of (key, chunks) in the order of keys, chunks is an async generator
+    # over the object's content and has to be read to the end before the next object is taken.
+    # Up to `prefetch` objects are read ahead concurrently and every one of them holds at most
+    # `buffered_chunks` chunks, so memory doesn't grow with the size of the objects.
+    # An S3 error is raised from the object's chunks.
+    async def fetch(key, queue):
+        try:
+            s3_object = await run_in_threadpool(s3.get_object, Bucket=bucket, Key=key)
+            async for chunk in stream_object(s3_object["Body"]):
+                await queue.put(chunk)
+            await queue.put(None)
+        except (ClientError, BotoCoreError) as e:
+            await queue.put(e)
+
+    async def chunks(queue):
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    keys = iter(keys)
+    running = deque()
+    tasks = []
+    try:
+        while True:
+            for key in keys:
+                queue = asyncio.Queue(buffered_chunks)
+                task = asyncio.create_task(fetch(key, queue))
+                tasks.append(task)
+                running.append((key, queue))
+                if len(running) >= prefetch:
+                    break
+            if not running:
+                break
+            key, queue = running.popleft()
+            yield key, chunks(queue)
+            tasks = [x for x in tasks if not x.done()]
+    finally:
+        # the consumer may stop in the middle, e.g. when the client goes away
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def content_disposition(filename):
+    # same format as starlette's FileResponse
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'